@@ -1,3 +1,6 @@
+import collections
+import concurrent.futures
+
 import numpy as np
 
 # +------------+
@@ -35,38 +38,438 @@ def calculate_ema(price, n, m=0):
     return ema_i
 
 
-def calculate_ma(price, n, m, mode='sma'):
+# Ring Buffer for Indicator (AO, AC, Moving Average)
+class IndicatorBuffer(object):
+    """
+    定长环形缓冲区, 每行(row)保存一只股票最近capacity个指标值
+    同时记录reset后前capacity个值的上行/下行步数, is_up_going与原列表版本一致 (检查reset后的前nday个值)
+    row 可以是单个序号 (逐只股票, 走标量路径), 也可以是序号数组 (批量计算)
+    """
+    FIELDS = ('values', 'pos', 'count', 'head_up', 'head_down')
+
+    def __init__(self, capacity=5, values=(), size=1):
+        self.capacity  = capacity
+        self.values    = np.zeros((size, capacity))
+        self.pos       = np.zeros(size, dtype=int)    # 下一个写入位置
+        self.count     = np.zeros(size, dtype=int)    # 累计写入个数
+        self.head_up   = np.zeros(size, dtype=int)    # 前capacity个值中从头开始连续不下行的步数
+        self.head_down = np.zeros(size, dtype=int)    # 前capacity个值中从头开始连续不上行的步数
+
+        self.reset(values=values)
+
+    def reset(self, rows=slice(None), values=()):
+        """
+        清空rows并依次写入values
+        """
+        rows = np.arange(len(self.count))[rows]
+
+        self.values[rows]    = 0
+        self.pos[rows]       = 0
+        self.count[rows]     = 0
+        self.head_up[rows]   = 0
+        self.head_down[rows] = 0
+
+        for value in values:
+            self.append(value, rows)
+
+        return
+
+    def append(self, value, row=0):
+
+        if isinstance(row, (int, np.integer)):
+            return self._append_row(int(row), float(value))
+
+        pos   = self.pos[row]
+        count = self.count[row]
+        last  = self.values[row, pos-1]
+
+        # 只在写入前capacity个值时延长从头开始的连续步数
+        head = (count > 0) & (count < self.capacity)
+        self.head_up[row]   += head & (self.head_up[row] == count-1)   & ~(last > value)
+        self.head_down[row] += head & (self.head_down[row] == count-1) & ~(last < value)
+
+        self.values[row, pos] = value
+
+        self.pos[row]   = (pos+1) % self.capacity
+        self.count[row] = count+1
+
+        return
+
+    def _append_row(self, row, value):
+        """
+        单行写入: 用Python标量更新, 避免逐次花式索引
+        """
+        values = self.values[row]
+        pos    = int(self.pos[row])
+        count  = int(self.count[row])
+
+        if 0 < count < self.capacity:
+            last = values[pos-1]
+            if self.head_up[row] == count-1 and not last > value:
+                self.head_up[row] = count
+            if self.head_down[row] == count-1 and not last < value:
+                self.head_down[row] = count
+
+        values[pos] = value
+
+        self.pos[row]   = (pos+1) % self.capacity
+        self.count[row] = count+1
+
+        return
+
+    def _ordered_row(self, row):
+        values = self.values[row].tolist()
+        pos    = int(self.pos[row])
+        return values[pos:] + values[:pos]
+
+    def take(self, rows):
+        """
+        复制rows为新的缓冲区
+        """
+        buffer = IndicatorBuffer(self.capacity, size=len(rows))
+        for field in self.FIELDS:
+            setattr(buffer, field, getattr(self, field)[rows].copy())
+        return buffer
+
+    def put(self, rows, buffer, buffer_rows=slice(None)):
+        """
+        把buffer的buffer_rows行写回rows
+        """
+        for field in self.FIELDS:
+            getattr(self, field)[rows] = getattr(buffer, field)[buffer_rows]
+        return
+
+    def last(self, row=0):
+        return self.values[row, self.pos[row]-1]
+
+    def ordered(self, row=0):
+        """
+        按写入顺序排列的最近capacity个值 (不足时前面补0)
+        """
+        order = (np.expand_dims(self.pos[row], -1) + np.arange(self.capacity)) % self.capacity
+        return np.take_along_axis(self.values[row], order, axis=-1)
+
+    def mean(self, row=0):
+        """
+        最近capacity个值的均值 (不足时为已写入值的均值)
+        按写入顺序求和, 与 calculate_sma 对原列表的结果逐位一致
+        """
+        if isinstance(row, (int, np.integer)):
+            total = 0.
+            for value in self._ordered_row(row):
+                total += value
+            return total / min(int(self.count[row]), self.capacity)
+        return self.ordered(row).sum(axis=-1) / np.minimum(self.count[row], self.capacity)
+
+    def is_up_going(self, nday, row=0):
+        """
+        同 is_up_going(列表, nday): 已写入不少于nday个值, 且reset后的前nday个值不下行
+        """
+        if isinstance(row, (int, np.integer)):
+            return nday <= self.count[row] and self.head_up[row] >= nday-1
+        return (nday <= self.count[row]) & (self.head_up[row] >= nday-1)
+
+    def is_down_going(self, nday, row=0):
+        if isinstance(row, (int, np.integer)):
+            return nday <= self.count[row] and self.head_down[row] >= nday-1
+        return (nday <= self.count[row]) & (self.head_down[row] >= nday-1)
+
+
+# Streaming Moving Average
+class StreamingMA(object):
+    """
+    流式均线, 每根新bar调用update, O(1)更新; 基类即为SMA
+    n: n period - calculate period
+    m: m period - moving period (value为m根bar之前的均线值)
+    """
+    def __init__(self, n, m=0):
+        self.n       = n
+        self.m       = m
+        self.window  = collections.deque(maxlen=n)        # 最近n个价格, 用于SMA及初始值
+        self.total   = 0.                                 # window中非nan价格之和
+        self.nans    = 0                                  # window中nan的个数
+        self.outputs = collections.deque(maxlen=m+1)      # 最近m+1个均线值, 用于平移读取
+
+    def update(self, price):
+        price = float(price)
+        if len(self.window) == self.n:
+            oldest = self.window[0]
+            if oldest != oldest: self.nans  -= 1
+            else:                self.total -= oldest
+        self.window.append(price)
+        if price != price: self.nans  += 1
+        else:              self.total += price
+        self.outputs.append(self._update(price) if len(self.window) == self.n else np.nan)
+        return self.value
+
+    def mean(self):
+        """
+        窗口均值, 窗口内有nan时为nan (与calculate_sma一致)
+        """
+        if self.nans: return np.nan
+        return self.total / self.n
+
+    def warm_up(self, price):
+        """
+        用历史价格序列预热
+        """
+        for p in price:
+            self.update(p)
+        return self.value
+
+    @property
+    def value(self):
+        if len(self.outputs) <= self.m: return np.nan
+        return self.outputs[0]
+
+    def _update(self, price):
+        return self.mean()
+
+
+class StreamingSMA(StreamingMA):
+    """
+    SMA = SUM (PRICE, n) / n
+    """
+
+
+class StreamingEMA(StreamingMA):
+    """
+    EMA = EMA(i-1) + 2/(n+1) * (PRICE - EMA(i-1)), 以前n根SMA为初始值
+    注意: 与calculate_ema不同, calculate_ema每次在最近n根窗口内以第一根为初始值重新递推 (alpha逐根变化),
+    不是连续递推的EMA, 两者数值不相等
+    """
+    def __init__(self, n, m=0):
+        super(StreamingEMA, self).__init__(n, m)
+        self.alpha = 2./(n+1)
+        self.ma    = None
+
+    def _update(self, price):
+        if self.ma is None:
+            self.ma = self.mean()
+        else:
+            self.ma = self.ma + self.alpha*(price-self.ma)
+        return self.ma
+
+
+class StreamingSMMA(StreamingMA):
+    """
+    SMMA = (SMMA(i-1) * (n-1) + PRICE) / n, 以前n根SMA为初始值 (Williams Alligator)
+    """
+    def __init__(self, n, m=0):
+        super(StreamingSMMA, self).__init__(n, m)
+        self.ma = None
+
+    def _update(self, price):
+        if self.ma is None:
+            self.ma = self.mean()
+        else:
+            self.ma = (self.ma*(self.n-1) + price) / self.n
+        return self.ma
+
+
+STREAMING_MA = {
+    'sma':  StreamingSMA,
+    'ema':  StreamingEMA,
+    'smma': StreamingSMMA,
+}
+
+
+def calculate_smma(price, n, m=0):
+    """
+    n: n period - calculate period
+    m: m period - moving period
+    SMMA = (SMMA(i-1) * (n-1) + PRICE) / n, 以前n根SMA为初始值, 与StreamingSMMA结果一致
+    对整段价格递推, 逐根bar计算时应传入 calculate_ma 的 ma 参数
+    """
+    if m != 0: price = price[:-m]
+    if len(price) < n: return np.nan
+
+    smma = price[:n].mean()
+
+    for p in price[n:].tolist():
+        smma = (smma*(n-1) + p) / n
+
+    return smma
+
+
+def create_ma(n, m=0, mode='sma', price=None):
+    """
+    创建流式均线, price不为空时用历史价格预热
+    """
+    ma = STREAMING_MA[mode](n, m)
+    if price is not None: ma.warm_up(price)
+    return ma
+
+
+def calculate_ma(price, n, m, mode='sma', ma=None):
+    """
+    mode: 'sma' / 'ema' 按窗口计算, 'smma' 对整段价格递推
+    ma: 该股票的流式均线 (create_ma(n, m, mode)), 给出时只用price的最后一根bar更新, O(1)
+        每根bar只能调用一次; mode='ema' 时结果为连续递推的EMA, 见StreamingEMA
+    """
+    if ma is not None:
+        return ma.update(price[-1])
     if mode == 'sma':
         ma = calculate_sma(price, n, m)
     if mode == 'ema':
         ma = calculate_ema(price, n, m)
+    if mode == 'smma':
+        ma = calculate_smma(price, n, m)
     return ma
 
+
+def calculate_sma_series(price, n, m=0):
+    """
+    n: n period - calculate period
+    m: m period - moving period
+    滑动窗口计算整段序列的SMA, 沿最后一维计算, 不足n+m根的位置为nan
+    第t位的值等于 calculate_sma(price[..., :t+1], n, m)
+    每个窗口单独求均值, 价格中的nan (如上市前的补齐) 只影响包含它的窗口
+    """
+    price = np.asarray(price, dtype=float)
+
+    sma = np.full(price.shape, np.nan)
+    if price.shape[-1] >= n+m:
+        windows = np.lib.stride_tricks.sliding_window_view(price, n, axis=-1)
+        sma[..., n-1+m:] = windows[..., :price.shape[-1]-n+1-m, :].mean(axis=-1)
+
+    return sma
+
+
 # Function for Alligator Indicator
+def calculate_alligator(close):
+    """
+    计算整段序列的鳄鱼线, 返回 (jaw, teeth, lips)
+    """
+    # Blue  Alligator’s Jaw   [13 bars SMMA(SMA) moved into the future by 8 bars]
+    jaw   = calculate_sma_series(close, n=13, m=8)
+    # Red   Alligator’s Teeth [ 8 bars SMMA(SMA) moved into the future by 5 bars]
+    teeth = calculate_sma_series(close, n=8,  m=5)
+    # Green Alligator’s Lips  [ 5 bars SMMA(SMA) moved into the future by 3 bars]
+    lips  = calculate_sma_series(close, n=5,  m=3)
+
+    return jaw, teeth, lips
+
+
+def is_sleeping_series(close, nday, threshold=0.02):
+    """
+    判断最近nday根bar内鳄鱼线是否曾经收拢(沉睡)
+    close为二维数组时按行判断, 返回布尔数组
+    """
+    jaw, teeth, lips = calculate_alligator(close)
+
+    jaw, teeth, lips = jaw[..., -nday:], teeth[..., -nday:], lips[..., -nday:]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        converged = (np.abs(jaw/teeth-1) < threshold) & (np.abs(teeth/lips-1) < threshold)
+
+    return converged.any(axis=-1)
+
+
 def check_sleeping(stock, nday):
-    
-    is_sleeping = False
 
     close = attribute_history(security=stock, count=30+nday, unit='1d', fields='close', df=False)['close']
 
-    for day in range(nday):
-        # Blue  Alligator’s Jaw   [13 bars SMMA(SMA) moved into the future by 8 bars]
-        ma_b = calculate_ma(price=close, n=13, m=8, mode='sma')
-        # Red   Alligator’s Teeth [ 8 bars SMMA(SMA) moved into the future by 5 bars]
-        ma_r = calculate_ma(price=close, n=8,  m=5, mode='sma')
-        # Green Alligator’s Lips  [ 5 bars SMMA(SMA) moved into the future by 3 bars]
-        ma_g = calculate_ma(price=close, n=5,  m=3, mode='sma')
+    is_sleeping = bool(is_sleeping_series(close, nday))
 
-        if abs(ma_b/ma_r-1) < 0.02 and abs(ma_r/ma_g-1) < 0.02:
-            
-            is_sleeping = True
-            
-            break
+    return is_sleeping
 
-        close = close[:-1] # check nday before
 
-    return is_sleeping
-    
+def scan_sleeping(stock_list, nday):
+    """
+    批量检查鳄鱼线沉睡, 一次取回 (股票 x bar) 收盘价矩阵, 返回沉睡的股票列表
+    """
+    if len(stock_list) == 0: return []
+
+    hist = history(count=30+nday, unit='1d', field='close', security_list=stock_list, df=False)
+
+    close = np.vstack([hist[stock] for stock in stock_list])
+
+    is_sleeping = is_sleeping_series(close, nday)
+
+    return [stock for stock, sleeping in zip(stock_list, is_sleeping) if sleeping]
+
+
+# Per-Stock State Table
+class StockState(object):
+    """
+    按股票序号存放的状态表 (struct of arrays), 逐只股票与批量信号计算共用
+    """
+    ARRAYS  = ('price_high', 'price_low', 'fractal_up', 'fractal_down', 'amount', 'fractal_index', 'fractal_synced',
+               'teeth', 'teeth_synced')
+    BUFFERS = ('AO_indicator', 'AC_indicator')
+
+    def __init__(self, stock_list):
+        size = len(stock_list)
+
+        self.stocks = list(stock_list)
+        self.index  = {stock: i for i, stock in enumerate(self.stocks)}
+
+        self.price_high   = np.zeros(size)              # 向上碎形最高价
+        self.price_low    = np.zeros(size)              # 向下碎形最低价
+
+        self.fractal_up   = np.zeros(size, dtype=bool)  # 判断有效向上碎形
+        self.fractal_down = np.zeros(size, dtype=bool)  # 判断有效向下碎形
+
+        self.AO_indicator = IndicatorBuffer(5, size=size)   # 存放最近5个AO指标数据
+        self.AC_indicator = IndicatorBuffer(5, size=size)   # 存放最近5个AC指标数据
+        self.amount       = np.zeros(size)              # 满仓仓位
+
+        self.fractal_index  = np.empty(size, dtype=object)  # 碎形索引
+        self.fractal_synced = np.zeros(size, dtype=int)     # 碎形索引已同步到的bar计数
+
+        self.teeth          = np.empty(size, dtype=object)  # 流式齿线 (StreamingSMA)
+        self.teeth_synced   = np.zeros(size, dtype=int)     # 齿线已同步到的bar计数
+
+        self.reset()
+
+    def reset(self, rows=slice(None)):
+        """
+        向量化重置rows的状态
+        """
+        self.price_high[rows] = 0
+        self.price_low[rows]  = 0
+
+        self.fractal_up[rows]   = False
+        self.fractal_down[rows] = False
+
+        self.AO_indicator.reset(rows, [0])
+        self.AC_indicator.reset(rows, [0])
+        self.amount[rows] = 0
+
+        self.fractal_index[rows]  = None
+        self.fractal_synced[rows] = 0
+
+        self.teeth[rows]        = None
+        self.teeth_synced[rows] = 0
+
+        return
+
+    def take(self, stock_list):
+        """
+        复制stock_list的状态为新的状态表
+        """
+        rows  = [self.index[stock] for stock in stock_list]
+        state = StockState(stock_list)
+        for field in self.ARRAYS:
+            setattr(state, field, getattr(self, field)[rows].copy())
+        for field in self.BUFFERS:
+            setattr(state, field, getattr(self, field).take(rows))
+        return state
+
+    def put(self, state, stock_list=None):
+        """
+        把state中stock_list(默认全部)的状态写回
+        """
+        if stock_list is None: stock_list = state.stocks
+        rows_src = [state.index[stock] for stock in stock_list]
+        rows_dst = [self.index[stock] for stock in stock_list]
+        for field in self.ARRAYS:
+            getattr(self, field)[rows_dst] = getattr(state, field)[rows_src]
+        for field in self.BUFFERS:
+            getattr(self, field).put(rows_dst, getattr(state, field), rows_src)
+        return
+
 
 # Function Excuted Monthly
 def check_monthly(context):
@@ -81,58 +484,29 @@ def check_monthly(context):
         log.info('[Reset Position] {}'.format(stock))
 
     # Reset Global Parameters
-    g.price_high = {}   # 向上碎形最高价
-    g.price_low  = {}   # 向下碎形最低价
-    
-    g.fractal_up   = {} # 判断有效向上碎形
-    g.fractal_down = {} # 判断有效向下碎形
-    
-    g.AO_indicator = {} # 存放连续的AO指标数据
-    g.AC_indicator = {} # 存放连续的AC指标数据
-    g.amount       = {} # 满仓仓位
-    
-    g.stock_list_bought = []
+    g.state.reset()
 
     # Get History Record (Duration: 30 days, Interval: 1 day)
-    for stock in g.stock_list:
-
-        is_sleeping = check_sleeping(stock, nday=20)
-        
-        if is_sleeping:
-            
-            g.stock_list_bought.append(stock)
-            
-            # Initial Stock Info
-            g.price_high[stock] = 0 # 向上碎形最高价
-            g.price_low[stock]  = 0 # 向下碎形最低价
+    if g.batch_scan:
+        g.stock_list_bought = scan_sleeping(g.stock_list, nday=20)
+    else:
+        g.stock_list_bought = [stock for stock in g.stock_list if check_sleeping(stock, nday=20)]
 
-            g.fractal_up[stock]   = False # 判断有效向上碎形
-            g.fractal_down[stock] = False # 判断有效向下碎形
-            
-            g.AO_indicator[stock] = [0] # 存放连续的AO指标数据
-            g.AC_indicator[stock] = [0] # 存放连续的AC指标数据
-            g.amount[stock]       = 0   # 满仓仓位
-    
     return None
 
 
 # Main
 def initialize(context):
 
-    g.price_high = {}           # 向上碎形最高价
-    g.price_low  = {}           # 向下碎形最低价
-    
-    g.fractal_up   = {}         # 判断有效向上碎形
-    g.fractal_down = {}         # 判断有效向下碎形
-    
-    g.AO_indicator = {}         # 存放连续的AO指标数据
-    g.AC_indicator = {}         # 存放连续的AC指标数据
-
-    g.amount = {}               # 满仓仓位
+    g.bar_count = 0             # handle_data计数
     g.stock_list_bought = []
     
     g.market_index = '000300.XSHG' # 沪深300
     g.stock_list = get_index_stocks(g.market_index)   
+    g.batch_scan = True            # 批量检查鳄鱼线沉睡
+    g.signal_workers = 0           # 计算信号的进程数 (0: 逐只计算)
+
+    g.state = StockState(g.stock_list) # 个股状态表
     
     set_benchmark(g.market_index)
     
@@ -146,6 +520,37 @@ def initialize(context):
 # +-------------+
 # | Handle Data |
 # +-------------+
+# Function for Bar Cache
+BAR_FIELDS = ['open', 'high', 'low', 'close']
+BAR_COUNT  = 35  # 最宽的历史窗口 (AO指标需要35根bar)
+
+_bar_cache = {'dt': None, 'bars': {}}
+
+
+def reset_bar_cache(dt):
+    """
+    bar时间戳变化时清空OHLC窗口缓存
+    """
+    if _bar_cache['dt'] != dt:
+        _bar_cache['dt']   = dt
+        _bar_cache['bars'] = {}
+    return
+
+
+def get_bar_history(stock, count, field):
+    """
+    同一根bar内每只股票只取一次OHLC窗口, 返回最近count根bar的field视图
+    """
+    count_cached, bars = _bar_cache['bars'].get(stock, (0, None))
+
+    if count_cached < count:
+        count_cached = max(count, BAR_COUNT)
+        bars = attribute_history(security=stock, count=count_cached, unit='1d', fields=BAR_FIELDS, df=False)
+        _bar_cache['bars'][stock] = (count_cached, bars)
+
+    return bars[field][-count:]
+
+
 # Function for Market Return
 def calculate_market_return(market_index, duration):
     """
@@ -231,15 +636,14 @@ def calculate_AO_indicator(stock):
     MEDIAN = (HIGH + LOW) / 2
     AO = SMA (MEDIAN, 5) - SMA (MEDIAN, 34)
     """
-    hist = attribute_history(security=stock, count=35, unit='1d', fields=['high', 'low'], df=False)
-    price_median = (hist['high']+hist['low'])/2
+    price_median = (get_bar_history(stock, 35, 'high')+get_bar_history(stock, 35, 'low'))/2
 
     mid_sma_5d  = calculate_sma(price=price_median, n=5,  m=0)
     mid_sma_34d = calculate_sma(price=price_median, n=34, m=0)
 
     AO = mid_sma_5d - mid_sma_34d
 
-    g.AO_indicator[stock].append(AO)
+    g.state.AO_indicator.append(AO, g.state.index[stock])
 
     return
 
@@ -251,75 +655,202 @@ def calculate_AC_indicator(stock):
     """
     calculate_AO_indicator(stock)
 
-    if len(g.AO_indicator[stock]) >= 5:
+    i = g.state.index[stock]
 
-        AO = g.AO_indicator[stock][-1]
+    if g.state.AO_indicator.count[i] >= 5:
 
-        price_AO = np.array(g.AO_indicator[stock])
+        AO = g.state.AO_indicator.last(i)
 
-        sma_AO_5d = calculate_sma(price=price_AO, n=5)
+        sma_AO_5d = g.state.AO_indicator.mean(i)
 
         AC = AO - sma_AO_5d
 
-        g.AC_indicator[stock].append(AC)
+        g.state.AC_indicator.append(AC, i)
 
     return
 
 
 # Function for Fractal Indicator
+def detect_fractals(price, direction):
+    """
+    滑动窗口检测整段序列的碎形, 沿最后一维计算
+    第i位为True表示以第i根bar为中心的5根bar构成碎形:
+    up:   中心最高价严格高于左右各两根bar
+    down: 中心最低价严格低于左右各两根bar
+    """
+    price = np.asarray(price, dtype=float)
+
+    is_fractal = np.zeros(price.shape, dtype=bool)
+    if price.shape[-1] < 5: return is_fractal
+
+    # 5根bar的滑动窗口: 中心与左右各两根bar的错位视图
+    center = price[..., 2:-2]
+    sides  = (price[..., :-4], price[..., 1:-3], price[..., 3:-1], price[..., 4:])
+
+    if direction == 'up':
+        is_fractal[..., 2:-2] = (center > sides[0]) & (center > sides[1]) & (center > sides[2]) & (center > sides[3])
+    if direction == 'down':
+        is_fractal[..., 2:-2] = (center < sides[0]) & (center < sides[1]) & (center < sides[2]) & (center < sides[3])
+
+    return is_fractal
+
+
+class FractalIndex(object):
+    """
+    碎形索引, 记录所有向上/向下碎形的 {中心bar序号: 价格}
+    建立索引及一次追加多根bar时用detect_fractals整段检测, 逐根追加时只比较新出现的一个窗口
+    注意: 索引只记录原始碎形 (5根bar形态), 不做鳄鱼齿线过滤;
+    齿线随bar变化, 碎形是否有效 (高于/低于齿线) 在check_fractal_indicator中按当根bar的齿线判断
+    """
+    def __init__(self, high=(), low=()):
+        self.count    = 0                           # 已追加的bar数
+        self.tail     = ([], [])                    # 最近4根bar的 high/low, 用于衔接下一次追加
+        self.fractals = {'up': {}, 'down': {}}
+
+        self.extend(high, low)
+
+    def append(self, high, low):
+        """
+        追加一根bar, 只检查以倒数第3根为中心的窗口
+        """
+        tail_high, tail_low = self.tail
+
+        if len(tail_high) == 4:
+            window_high = tail_high + [high]
+            window_low  = tail_low + [low]
+
+            # 中心为 window[2], 对应第 count-2 根bar
+            center = window_high[2]
+            if center > window_high[0] and center > window_high[1] and center > window_high[3] and center > high:
+                self.fractals['up'][self.count-2] = center
+            center = window_low[2]
+            if center < window_low[0] and center < window_low[1] and center < window_low[3] and center < low:
+                self.fractals['down'][self.count-2] = center
+
+            self.tail = (window_high[1:], window_low[1:])
+        else:
+            self.tail = (tail_high + [high], tail_low + [low])
+
+        self.count += 1
+
+        return
+
+    def extend(self, high, low):
+
+        price  = np.array([self.tail[0] + list(high), self.tail[1] + list(low)], dtype=float)
+        offset = self.count - len(self.tail[0])
+
+        for direction, row in (('up', 0), ('down', 1)):
+            is_fractal = detect_fractals(price[row], direction)
+            if is_fractal.any():
+                for i in np.flatnonzero(is_fractal):
+                    self.fractals[direction][int(offset+i)] = float(price[row, i])
+
+        self.count = offset + price.shape[1]
+        self.tail  = (price[0, -4:].tolist(), price[1, -4:].tolist())
+
+        return
+
+    def fractal_at(self, direction, bar):
+        """
+        以第bar根为中心的碎形价格, 不是碎形时返回None
+        """
+        return self.fractals[direction].get(bar)
+
+
+def get_fractal_index(stock):
+    """
+    股票的碎形索引, 按handle_data计数补齐上次同步以来的bar
+    首次使用或间隔超过OHLC窗口时用整个窗口重建, 每根bar同步时逐根追加
+    """
+    i = g.state.index[stock]
+
+    fractal_index = g.state.fractal_index[i]
+    gap = g.bar_count - g.state.fractal_synced[i]
+
+    if fractal_index is None or gap >= BAR_COUNT:
+        fractal_index = FractalIndex(get_bar_history(stock, BAR_COUNT, 'high'), get_bar_history(stock, BAR_COUNT, 'low'))
+        g.state.fractal_index[i] = fractal_index
+    elif gap == 1:
+        fractal_index.append(float(get_bar_history(stock, 1, 'high')[0]), float(get_bar_history(stock, 1, 'low')[0]))
+    elif gap > 1:
+        fractal_index.extend(get_bar_history(stock, gap, 'high'), get_bar_history(stock, gap, 'low'))
+
+    g.state.fractal_synced[i] = g.bar_count
+
+    return fractal_index
+
+
+def get_teeth(stock, hist_close):
+    """
+    股票的流式齿线, 已同步到上一根bar, 由calculate_ma用当根bar更新
+    首次使用或间隔超过OHLC窗口时用hist_close (不含当根bar) 重建, 否则补齐中间跳过的bar
+    """
+    i = g.state.index[stock]
+
+    teeth = g.state.teeth[i]
+    gap = g.bar_count - g.state.teeth_synced[i]
+
+    if teeth is None or gap >= len(hist_close):
+        teeth = create_ma(n=5, m=8, mode='sma', price=hist_close[:-1])
+        g.state.teeth[i] = teeth
+    elif gap > 1:
+        teeth.warm_up(hist_close[-gap:-1])
+
+    g.state.teeth_synced[i] = g.bar_count
+
+    return teeth
+
+
 def check_fractal_indicator(stock, direction):
 
-    hist_close = attribute_history(security=stock, count=30, unit='1d', fields='close', df=False)['close']
+    hist_close = get_bar_history(stock, BAR_COUNT, 'close')
     
     # Red Alligator’s Teeth [ 8 bars SMMA(SMA) moved into the future by 5 bars]
-    ma_r = calculate_ma(price=hist_close, m=8, n=5, mode='sma')
+    ma_r = calculate_ma(price=hist_close, m=8, n=5, mode='sma', ma=get_teeth(stock, hist_close))
+
+    i = g.state.index[stock]
+
+    # 最近5根bar的中心
+    fractal_index = get_fractal_index(stock)
+    bar = fractal_index.count - 3
 
     if direction == 'up':
         
-        hist_high  = attribute_history(security=stock, count=5, unit='1d', fields='high', df=False)['high']
+        high = fractal_index.fractal_at('up', bar)
 
-        if max(hist_high) == hist_high[2] and sum(hist_high==hist_high[2]) == 1:
-            
-            high = hist_high[2]
+        if high is not None:
             
-            g.price_high[stock] = high
+            g.state.price_high[i] = high
 
-            if high > ma_r:
-                g.fractal_up[stock] = True
-            else:
-                g.fractal_up[stock] = False
+            g.state.fractal_up[i] = high > ma_r
 
     if direction == 'down':
         
-        hist_low  = attribute_history(security=stock, count=5, unit='1d', fields='low', df=False)['low']
+        low = fractal_index.fractal_at('down', bar)
 
-        if min(hist_low) == hist_low[2] and sum(hist_low==hist_low[2]) == 1:
-            
-            low = hist_low[2]
+        if low is not None:
 
-            g.price_low[stock] = low
-        
-            if low < ma_r:
-                g.fractal_down[stock] = True
-            else:
-                g.fractal_down[stock] = False
+            g.state.price_low[i] = low
+
+            g.state.fractal_down[i] = low < ma_r
 
     return
 
 
 def is_fractal_broken(stock, direction):
     
-    close = attribute_history(security=stock, count=1, unit='1d', fields='close', df=False)['close'][0]
+    close = get_bar_history(stock, 1, 'close')[0]
 
     if direction == 'up':
 
-        if close > g.price_high[stock]:
+        if close > g.state.price_high[g.state.index[stock]]:
         
             return True
 
     if direction == 'down':
         
-        if close < g.price_low[stock]:
+        if close < g.state.price_low[g.state.index[stock]]:
             
             return True
 
@@ -351,57 +882,216 @@ def is_down_going(check_list, nday):
     return True
 
 
-def initial_position(stock, context):
+# Function for Order Plan
+ADJUST_RATIO = {'add': 0.1, 'reduce': -0.1}   # 加仓/减仓比例
+
+
+def execute_order_plan(context, intents):
+    """
+    汇总当日所有个股的操作后统一下单: 先卖后买, 只读取一次行情
+    买单按成本从低到高, 用累计成本一次性分配可用资金 (与股票顺序无关)
+    intents: [(stock, actions)], actions 见 evaluate_signal
+    """
+    if len(intents) == 0: return
+
+    sells = []  # (stock, action, share)
+    buys  = []  # (stock, action, share)
+
+    for stock, actions in intents:
+
+        i = g.state.index[stock]
+
+        for action in actions:
 
+            if action == 'clear':
+                sells.append((stock, action, 0))
+
+            if action == 'buy':
+                buys.append((stock, action, 100))
+
+            if action in ADJUST_RATIO:
+                share = np.ceil(g.state.amount[i]*ADJUST_RATIO[action]/100)*100
+                if share > 0: buys.append((stock, action, share))
+                if share < 0: sells.append((stock, action, share))
+
+    # [卖出]
+    for stock, action, share in sells:
+
+        if action == 'clear':
+            # [清仓]
+            order_target(security=stock, amount=0)
+            log.info('[Clear Position] Sell all shares of {}'.format(stock))
+            g.state.fractal_up[g.state.index[stock]] = False
+        else:
+            # [减仓]
+            order(security=stock, amount=share)
+            log.info('[Adjust Position] Sell {} shares of {}'.format(-share, stock))
+
+    if len(buys) == 0: return
+
+    # [买入 - 分配资金]
     current_data = get_current_data()
-    last_price = current_data[stock].last_price
 
-    available_share = np.floor(context.portfolio.available_cash/last_price)
+    last_price = np.array([current_data[stock].last_price for stock, action, share in buys])
+    share      = np.array([share for stock, action, share in buys])
+    cost       = last_price*share
 
-    if available_share >= 100:
-        
-        share = 100
-        
-        g.amount[stock] = share
+    rank = np.argsort(cost, kind='stable')
+    is_filled = np.zeros(len(buys), dtype=bool)
+    is_filled[rank] = np.cumsum(cost[rank]) <= context.portfolio.available_cash
+
+    for (stock, action, share), filled in zip(buys, is_filled):
+
+        if not filled: continue
 
         order(security=stock, amount=share)
 
-        log.info('[Initial Position] Buy {} shares of {}'.format(share, stock))
-    
-        g.fractal_down[stock] = False
+        if action == 'buy':
+            # [建仓]
+            log.info('[Initial Position] Buy {} shares of {}'.format(share, stock))
+            g.state.amount[g.state.index[stock]]       = share
+            g.state.fractal_down[g.state.index[stock]] = False
+        else:
+            # [加仓]
+            log.info('[Adjust Position] Buy {} shares of {}'.format(share, stock))
 
     return
 
 
-def clear_position(stock, context):
+# Function for Signal
+def evaluate_signal(stock, in_position):
+    """
+    计算个股当日信号, 只更新 g.state 不下单
+    返回操作列表: 'buy' 建仓, 'clear' 清仓, 'add' 加仓, 'reduce' 减仓
+    """
+    actions = []
+
+    i = g.state.index[stock]
+
+    # [计算AO & AC指标]
+    calculate_AC_indicator(stock)
     
-    order_target(security=stock, amount=0)
+    # [空仓 - 建仓]
+    if not in_position:
+        
+        # [检查向上碎形]
+        check_fractal_indicator(stock, 'up')
 
-    log.info('[Clear Position] Sell all shares of {}'.format(stock))
+        # [检查向上碎形是否被突破]
+        if g.state.fractal_up[i]:
 
-    g.fractal_up[stock] = False
+            if is_fractal_broken(stock,'up'):
 
-    return
+                hist_close = get_bar_history(stock, 5, 'close')
+                
+                if  g.state.AO_indicator.is_up_going(nday=5, row=i) and \
+                    g.state.AC_indicator.is_up_going(nday=3, row=i) and \
+                    is_up_going(check_list=hist_close, nday=2):
+                    
+                    actions.append('buy')
+    
+    # [持仓 - 调整 or 清仓]
+    else:
 
+        # [检查向下碎形]
+        check_fractal_indicator(stock, 'down')
 
-def adjust_position(stock, context, ratio):
+        # [检查向下碎形是否被突破]
+        if g.state.fractal_down[i]:
 
-    current_data = get_current_data()
-    last_price = current_data[stock].last_price
+            if is_fractal_broken(stock,'down'):
+                
+                return ['clear']
 
-    available_share = np.floor(context.portfolio.available_cash/last_price)
-    
-    adjust_share = np.ceil(g.amount[stock]*ratio/100)*100
+        hist_close = get_bar_history(stock, 5, 'close')
 
-    if adjust_share <= available_share:
+        # [加仓10% - AO，AC同时5日上行，且收盘价走高]
+        if  g.state.AO_indicator.is_up_going(nday=5, row=i) and \
+            g.state.AC_indicator.is_up_going(nday=5, row=i) and \
+            is_up_going(check_list=hist_close, nday=2):
+            
+            actions.append('add')
 
-        order(security=stock, amount=adjust_share)
+        # [减仓10% - AO，AC同时3日下行，且收盘价走低]
+        if  g.state.AO_indicator.is_down_going(nday=3, row=i) and \
+            g.state.AC_indicator.is_down_going(nday=3, row=i) and \
+            is_down_going(check_list=hist_close, nday=2):
+            
+            actions.append('reduce')
 
-        log.info('[Adjust Position] Buy {} shares of {}'.format(adjust_share, stock))
+    return actions
 
+
+# Process Pool for Signal
+_signal_pool = {'workers': 0, 'pool': None}
+
+
+def get_signal_pool(workers):
+    if _signal_pool['workers'] != workers:
+        if _signal_pool['pool'] is not None: _signal_pool['pool'].shutdown()
+        _signal_pool['workers'] = workers
+        _signal_pool['pool']    = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return _signal_pool['pool']
+
+
+def close_signal_pool():
+    if _signal_pool['pool'] is not None: _signal_pool['pool'].shutdown()
+    _signal_pool['workers'] = 0
+    _signal_pool['pool']    = None
     return
 
 
+class ShardGlobals(object):
+    """
+    子进程内代替平台的 g, 只包含信号计算用到的状态
+    """
+    def __init__(self, state, bar_count):
+        self.state        = state
+        self.bar_count    = bar_count
+
+
+def evaluate_shard(shard):
+    """
+    子进程任务: 用主进程取好的OHLC窗口和状态副本, 计算一组股票的信号
+    """
+    global g
+
+    dt, bar_count, bars, state, positions = shard
+
+    g = ShardGlobals(state, bar_count)
+
+    # bars: (股票 x 字段 x bar) 的OHLC窗口
+    reset_bar_cache(dt)
+    for stock, stock_bars in zip(state.stocks, bars):
+        _bar_cache['bars'][stock] = (stock_bars.shape[-1], dict(zip(BAR_FIELDS, stock_bars)))
+
+    actions = [evaluate_signal(stock, stock in positions) for stock in state.stocks]
+
+    return actions, state
+
+
+def evaluate_signals_parallel(context, stock_list):
+    """
+    按进程池分片计算信号, 返回 {stock: (操作列表, 该股票的状态副本)}
+    下单及 g.state 的写回由主线程按股票顺序完成, 结果与逐只计算一致
+    """
+    if len(stock_list) == 0: return {}
+
+    shards = []
+    for shard in np.array_split(np.array(stock_list, dtype=object), min(g.signal_workers, len(stock_list))):
+        shard = list(shard)
+        bars = np.array([[get_bar_history(stock, BAR_COUNT, field) for field in BAR_FIELDS] for stock in shard])
+        positions = [stock for stock in shard if stock in context.portfolio.positions]
+        shards.append((context.current_dt, g.bar_count, bars, g.state.take(shard), positions))
+
+    signals = {}
+    for actions, state in get_signal_pool(g.signal_workers).map(evaluate_shard, shards):
+        for stock, stock_actions in zip(state.stocks, actions):
+            signals[stock] = (stock_actions, state)
+
+    return signals
+
+
 # Main
 def handle_data(context, data):
     """
@@ -409,10 +1099,21 @@ def handle_data(context, data):
     """
     log.info('[Portfolio] Available Cash {}'.format(context.portfolio.available_cash))
 
+    reset_bar_cache(context.current_dt)
+
+    g.bar_count += 1
+
     # [大盘止损]
     is_market_stop_loss = conduct_market_stop_loss(market_index=g.market_index, duration=3, min_return=-0.3)
     
     if is_market_stop_loss: return
+
+    # [进程池分片计算信号]
+    signals = None
+    if g.signal_workers > 0:
+        signals = evaluate_signals_parallel(context, g.stock_list_bought)
+
+    intents = []
     
     for stock in g.stock_list_bought:
         
@@ -423,61 +1124,28 @@ def handle_data(context, data):
         
         if is_stock_stop_loss or is_stock_take_profit: continue
 
-        # [计算AO & AC指标]
-        calculate_AC_indicator(stock)
-        
-        # [空仓 - 建仓]
-        if stock not in context.portfolio.positions:
-            
-            # [检查向上碎形]
-            check_fractal_indicator(stock, 'up')
-
-            # [检查向上碎形是否被突破]
-            if g.fractal_up[stock]:
-
-                if is_fractal_broken(stock,'up'):
-
-                    hist_close = attribute_history(security=stock, count=5, unit='1d', fields='close', df=False)['close']
-                    
-                    if  is_up_going(check_list=g.AO_indicator[stock], nday=5) and \
-                        is_up_going(check_list=g.AC_indicator[stock], nday=3) and \
-                        is_up_going(check_list=hist_close, nday=2):
-                        
-                        # [建仓]
-                        initial_position(stock, context)
-        
-        # [持仓 - 调整 or 清仓]
+        # [计算信号]
+        if signals is None:
+            actions = evaluate_signal(stock, stock in context.portfolio.positions)
         else:
+            actions, state = signals[stock]
+            g.state.put(state, [stock])
 
-            # [检查向下碎形]
-            check_fractal_indicator(stock, 'down')
+        intents.append((stock, actions))
 
-            # [检查向下碎形是否被突破]
-            if g.fractal_down[stock]:
+        # [清仓后当日不再处理后续股票]
+        if 'clear' in actions: break
 
-                if is_fractal_broken(stock,'down'):
-                    
-                    # [清仓]
-                    clear_position(stock,context)
-                    
-                    return
+    # [下单]
+    execute_order_plan(context, intents)
 
-            hist_close = attribute_history(security=stock, count=5, unit='1d', fields='close', df=False)['close']
+    return
 
-            # [加仓10% - AO，AC同时5日上行，且收盘价走高]
-            if  is_up_going(check_list=g.AO_indicator[stock], nday=5) and \
-                is_up_going(check_list=g.AC_indicator[stock], nday=5) and \
-                is_up_going(check_list=hist_close, nday=2):
-                
-                # [调整]
-                adjust_position(stock, context, ratio=0.1)
 
-            # [减仓10% - AO，AC同时3日下行，且收盘价走低]
-            if  is_down_going(check_list=g.AO_indicator[stock], nday=3) and \
-                is_down_going(check_list=g.AC_indicator[stock], nday=3) and \
-                is_down_going(check_list=hist_close, nday=2):
-                
-                # [调整]
-                adjust_position(stock, context, ratio=-0.1)
+def on_strategy_end(context):
+    """
+    回测结束
+    """
+    close_signal_pool()
 
     return
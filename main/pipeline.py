@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import os
+import time
+
+import akshare as ak
+import backtrader as bt
+
+from main.ma_strategy import QuietStrategy
+from utils.ak import TokenBucket, get_ak_stock_zh_a_daily, get_manifest, with_retry
+
+
+def run_backtest(symbol, stock_data, date_start, date_final, cash=10000, maperiod=15):
+    """
+    在进程池中运行: 单只股票的 QuietStrategy 回测, 返回 (期末市值, 耗时)
+    """
+    time_start = time.perf_counter()
+
+    cerebro = bt.Cerebro()
+    cerebro.addstrategy(QuietStrategy, maperiod=maperiod)
+    data = bt.feeds.PandasData(
+        dataname=stock_data,
+        fromdate=date_start,
+        todate=date_final
+    )
+    cerebro.adddata(data)
+
+    cerebro.broker.setcash(cash)
+    cerebro.addsizer(bt.sizers.FixedSize, stake=100)
+    cerebro.broker.setcommission(commission=0.002)
+    cerebro.run()
+
+    return cerebro.broker.getvalue(), time.perf_counter() - time_start
+
+
+async def produce(symbols, queue, load, executor, fetchers, stats):
+    """
+    最多 fetchers 只股票同时读取, 读取完成即放入队列
+    队列满时 put 等待, 占用的读取名额不释放, 读取随之暂停 (背压)
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(fetchers)
+
+    async def produce_one(symbol):
+        async with semaphore:
+            time_start = time.perf_counter()
+            try:
+                stock_data = await loop.run_in_executor(executor, load, symbol)
+            except Exception as e:
+                stats["failed"][symbol] = e
+                return
+            stats["load"] += time.perf_counter() - time_start
+            await queue.put((symbol, stock_data))
+            stats["depth"] = max(stats["depth"], queue.qsize())
+
+    await asyncio.gather(*[produce_one(symbol) for symbol in symbols])
+    return
+
+
+async def consume(queue, executor, results, stats, **kwargs):
+    """
+    从队列取出数据交给进程池回测, 收到 None 时退出
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        symbol, stock_data = item
+        try:
+            results[symbol], elapsed = await loop.run_in_executor(
+                executor, functools.partial(run_backtest, symbol, stock_data, **kwargs)
+            )
+            stats["run"] += elapsed
+        except Exception as e:
+            stats["failed"][symbol] = e
+
+
+async def run_pipeline(symbols, cache_dir, date_start, date_final, adjust="qfq", cash=10000, maperiod=15,
+                       fetchers=4, workers=2, queue_size=8, rate=5.0, fetch=None):
+    """
+    读取与回测重叠执行: 线程池读取 (含请求限速和重试) => 有界队列 => 进程池回测
+    返回 ({symbol: 期末市值}, stats)
+    """
+    fetch = with_retry(fetch or ak.stock_zh_a_daily, TokenBucket(rate, burst=fetchers))
+
+    def load(symbol):
+        # 只把回测区间的行传给进程池
+        return get_ak_stock_zh_a_daily(symbol, cache_dir, adjust=adjust, fetch=fetch, start=date_start, end=date_final)
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    results = {}
+    stats = {"load": 0., "run": 0., "depth": 0, "failed": {}}
+
+    time_start = time.perf_counter()
+    with get_manifest(cache_dir).batch(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=fetchers) as thread_pool, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as process_pool:
+        consumers = [
+            asyncio.ensure_future(consume(
+                queue, process_pool, results, stats,
+                date_start=date_start, date_final=date_final, cash=cash, maperiod=maperiod
+            ))
+            for _ in range(workers)
+        ]
+        await produce(symbols, queue, load, thread_pool, fetchers, stats)
+        for _ in range(workers):
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+    stats["wall"] = time.perf_counter() - time_start
+
+    return results, stats
+
+
+def report(symbols, results, stats, fetchers, workers):
+    print("=" * 80)
+    for symbol in symbols:
+        if symbol in results:
+            print("%-12s Final Portfolio Value: %.2f" % (symbol, results[symbol]))
+        elif symbol in stats["failed"]:
+            print("%-12s Failed: %r" % (symbol, stats["failed"][symbol]))
+    print("=" * 80)
+    print("Load: %.2f s (%d fetchers), Backtest: %.2f s (%d workers), Max Queue Depth: %d" % (
+        stats["load"], fetchers, stats["run"], workers, stats["depth"]
+    ))
+    print("Wall: %.2f s, Sequential: %.2f s, Throughput: %.2f symbols/s" % (
+        stats["wall"], stats["load"] + stats["run"], len(results) / max(stats["wall"], 1e-9)
+    ))
+    return
+
+
+if __name__ == "__main__":
+
+    """
+
+python -m main.pipeline --symbols sh600570 sh600309 sh600760
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbols", type=str, nargs="+", required=True)
+    parser.add_argument("--cache_dir", type=str, default="D:/Qingyu/Repos/stock/cache")
+    parser.add_argument("--maperiod", type=int, default=15)
+    parser.add_argument("--fetchers", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue_size", type=int, default=8)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_dir):
+        os.mkdir(args.cache_dir)
+        print("=" * 80)
+        print("mkdir => %s" % args.cache_dir)
+
+    results, stats = asyncio.run(run_pipeline(
+        args.symbols, args.cache_dir,
+        date_start=datetime.datetime(2020, 1, 1),
+        date_final=datetime.datetime(2020, 6, 29),
+        maperiod=args.maperiod,
+        fetchers=args.fetchers,
+        workers=args.workers,
+        queue_size=args.queue_size,
+    ))
+    report(args.symbols, results, stats, args.fetchers, args.workers)
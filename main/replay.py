@@ -0,0 +1,362 @@
+import argparse
+import collections
+import datetime
+import importlib
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.ak import get_ak_stock_zh_a_daily_bulk, get_ak_stock_zh_index_daily
+
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+
+
+def ak_to_jq(symbol):
+    """
+    sh600570 => 600570.XSHG
+    """
+    exchange = {"sh": "XSHG", "sz": "XSHE"}[symbol[:2]]
+    return "%s.%s" % (symbol[2:], exchange)
+
+
+def jq_to_ak(security):
+    """
+    600570.XSHG => sh600570
+    """
+    code, exchange = security.split(".")
+    return {"XSHG": "sh", "XSHE": "sz"}[exchange] + code
+
+
+def frame_to_bars(frame):
+    """
+    akshare日线 DataFrame => (日期数组, {字段: 数组})
+    """
+    if "date" in frame.columns:
+        frame = frame.set_index("date")
+    dates = pd.DatetimeIndex(frame.index).values.astype("datetime64[D]")
+    columns = {field: frame[field].values.astype(float) for field in FIELDS if field in frame.columns}
+    return dates, columns
+
+
+def load_bars(symbols, index_symbol, cache_dir, adjust="qfq"):
+    """
+    从 utils/ak.py 的缓存读取个股及指数日线
+    """
+    bars = {}
+    stock_data = get_ak_stock_zh_a_daily_bulk(
+        symbols, cache_dir=cache_dir, adjust=adjust, fmt="npy", columns=FIELDS, df=False, verbose=False
+    )
+    for symbol, (dates, columns) in stock_data.items():
+        bars[ak_to_jq(symbol)] = (dates.astype("datetime64[D]"), columns)
+    index_data = get_ak_stock_zh_index_daily(symbol=index_symbol, cache_dir=cache_dir)
+    bars[ak_to_jq(index_symbol)] = frame_to_bars(index_data)
+    return bars
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.total = collections.Counter()
+        self.worst = collections.Counter()
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            time_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - time_start
+                self.calls[stage] += 1
+                self.total[stage] += elapsed
+                self.worst[stage] = max(self.worst[stage], elapsed)
+        return timed
+
+
+class Position(object):
+
+    def __init__(self):
+        self.amount = 0
+        self.avg_cost = 0.
+
+
+class Portfolio(object):
+
+    def __init__(self, cash):
+        self.available_cash = cash
+        self.positions = {}
+
+
+class Context(object):
+
+    def __init__(self, cash):
+        self.current_dt = None
+        self.portfolio = Portfolio(cash)
+
+
+class G(object):
+    pass
+
+
+class SecurityData(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BarData(dict):
+
+    def __init__(self, replay):
+        super(BarData, self).__init__()
+        self.replay = replay
+
+    def __missing__(self, security):
+        bar = {field: self.replay.window(security, 1, field)[0] for field in ["open", "high", "low", "close"]}
+        bar["avg"] = (bar["high"] + bar["low"] + bar["close"]) / 3
+        self[security] = SecurityData(**bar)
+        return self[security]
+
+
+class Replay(object):
+    """
+    离线回放聚宽风格策略, 用缓存日线提供 g, log, attribute_history 等平台接口
+
+    当日handle_data在开盘时运行: 历史数据截止到前一交易日, 下单以当日开盘价成交
+    """
+
+    def __init__(self, bars, market_index, date_start, date_final, cash=1000000, commission=0.0003,
+                 strategy="main.alligator_indicator", params=None):
+        self.bars = bars
+        self.params = params or {}
+        self.market_index = market_index
+        self.commission = commission
+
+        dates = bars[market_index][0]
+        self.calendar = dates[(dates >= np.datetime64(date_start, "D")) & (dates <= np.datetime64(date_final, "D"))]
+
+        self.context = Context(cash)
+        self.timer = Timer()
+        self.bar_times = []
+        self.monthly = []
+        self.today = None
+        self.current_data = None
+
+        self.strategy = importlib.reload(importlib.import_module(strategy))
+        self.install(self.strategy)
+
+    # +--------------+
+    # | Platform API |
+    # +--------------+
+    def install(self, module):
+        module.g = G()
+        module.log = logging.getLogger("replay.%s" % module.__name__)
+        module.attribute_history = self.timer.wrap("attribute_history", self.attribute_history)
+        module.history = self.timer.wrap("history", self.history)
+        module.get_index_stocks = self.get_index_stocks
+        module.get_current_data = self.get_current_data
+        module.order = self.timer.wrap("order", self.order)
+        module.order_target = self.timer.wrap("order", self.order_target)
+        module.run_monthly = self.run_monthly
+        module.set_benchmark = self.set_benchmark
+        return
+
+    def window(self, security, count, field):
+        """
+        截止前一交易日的最近count根bar, 上市前不足部分以nan填充
+        """
+        dates, columns = self.bars[security]
+        end = np.searchsorted(dates, self.today, side="left")
+        values = columns[field][max(0, end-count):end]
+        if len(values) < count:
+            values = np.concatenate([np.full(count-len(values), np.nan), values])
+        return values
+
+    def attribute_history(self, security, count, unit="1d", fields=FIELDS, df=True, **kwargs):
+        if isinstance(fields, str):
+            fields = [fields]
+        hist = {field: self.window(security, count, field) for field in fields}
+        if df:
+            return pd.DataFrame(hist)
+        return hist
+
+    def history(self, count, unit="1d", field="avg", security_list=None, df=True, **kwargs):
+        hist = {security: self.window(security, count, field) for security in security_list}
+        if df:
+            return pd.DataFrame(hist)
+        return hist
+
+    def get_index_stocks(self, index_symbol, date=None):
+        return [security for security in self.bars if security != self.market_index]
+
+    def get_current_data(self):
+        if self.current_data is None:
+            self.current_data = self.load_current_data()
+        return self.current_data
+
+    def load_current_data(self):
+        current_data = {}
+        for security, (dates, columns) in self.bars.items():
+            i = np.searchsorted(dates, self.today, side="left")
+            paused = i >= len(dates) or dates[i] != self.today
+            if paused:
+                last_price = columns["close"][i-1] if i > 0 else np.nan
+            else:
+                last_price = columns["open"][i]
+            current_data[security] = SecurityData(last_price=last_price, paused=paused)
+        return current_data
+
+    def get_bar_data(self):
+        """
+        handle_data 的 data 参数: 前一交易日的bar, 按需读取
+        """
+        return BarData(self)
+
+    def order(self, security, amount):
+        last_price = self.get_current_data()[security].last_price
+        if np.isnan(last_price) or amount == 0:
+            return None
+
+        portfolio = self.context.portfolio
+        position = portfolio.positions.get(security)
+
+        if amount > 0:
+            amount = min(amount, np.floor(portfolio.available_cash / (last_price*(1+self.commission)) / 100) * 100)
+            if amount <= 0:
+                return None
+            if position is None:
+                position = portfolio.positions[security] = Position()
+            position.avg_cost = (position.avg_cost*position.amount + last_price*amount) / (position.amount+amount)
+            position.amount += amount
+            portfolio.available_cash -= last_price*amount*(1+self.commission)
+        else:
+            if position is None:
+                return None
+            amount = -min(-amount, position.amount)
+            position.amount += amount
+            portfolio.available_cash += -amount*last_price*(1-self.commission)
+            if position.amount == 0:
+                del portfolio.positions[security]
+        return amount
+
+    def order_target(self, security, amount):
+        position = self.context.portfolio.positions.get(security)
+        return self.order(security, amount - (position.amount if position else 0))
+
+    def run_monthly(self, func, monthday, time="open", **kwargs):
+        self.monthly.append((func, monthday))
+        return
+
+    def set_benchmark(self, security):
+        return
+
+    # +--------+
+    # | Replay |
+    # +--------+
+    def monthdays(self):
+        """
+        每个交易日在当月中的序号 (从1开始, 以及从月末倒数的负序号)
+        """
+        months = self.calendar.astype("datetime64[M]")
+        forward, backward = {}, {}
+        for month in np.unique(months):
+            days = self.calendar[months == month]
+            for i, day in enumerate(days):
+                forward[day] = i+1
+                backward[day] = i-len(days)
+        return forward, backward
+
+    def portfolio_value(self):
+        current_data = self.get_current_data()
+        portfolio = self.context.portfolio
+        return portfolio.available_cash + sum(
+            position.amount * current_data[security].last_price for security, position in portfolio.positions.items()
+        )
+
+    def run(self):
+        forward, backward = self.monthdays()
+
+        self.today = self.calendar[0]
+        self.current_data = None
+        self.context.current_dt = pd.Timestamp(self.today).to_pydatetime()
+        self.timer.wrap("initialize", self.strategy.initialize)(self.context)
+
+        # initialize之后覆盖 g 上的参数
+        for key, value in self.params.items():
+            setattr(self.strategy.g, key, value)
+
+        check_monthly = self.timer.wrap("check_monthly", lambda func, context: func(context))
+        handle_data = self.timer.wrap("handle_data", self.strategy.handle_data)
+
+        for today in self.calendar:
+            self.today = today
+            self.current_data = None
+            self.context.current_dt = pd.Timestamp(today).to_pydatetime() + datetime.timedelta(hours=9, minutes=30)
+
+            time_start = time.perf_counter()
+            for func, monthday in self.monthly:
+                if monthday in (forward[today], backward[today]):
+                    check_monthly(func, self.context)
+            handle_data(self.context, self.get_bar_data())
+            self.bar_times.append(time.perf_counter() - time_start)
+
+        if hasattr(self.strategy, "on_strategy_end"):
+            self.strategy.on_strategy_end(self.context)
+
+        return self.portfolio_value()
+
+    def report(self):
+        print("=" * 80)
+        print("%-20s %10s %12s %12s %12s" % ("Stage", "Calls", "Total (ms)", "Mean (ms)", "Max (ms)"))
+        for stage in self.timer.calls:
+            calls = self.timer.calls[stage]
+            total = self.timer.total[stage] * 1000
+            print("%-20s %10d %12.2f %12.4f %12.4f" % (stage, calls, total, total/calls, self.timer.worst[stage]*1000))
+        print("=" * 80)
+        bar_times = np.array(self.bar_times) * 1000
+        print("Bars: %d, Total: %.2f ms, p50: %.4f ms, p95: %.4f ms, Max: %.4f ms" % (
+            len(bar_times), bar_times.sum(), np.percentile(bar_times, 50), np.percentile(bar_times, 95), bar_times.max()
+        ))
+        return
+
+
+if __name__ == "__main__":
+
+    """
+
+python -m main.replay --symbols sh600570 sh600309 sh600760 --start 2015-01-01 --end 2020-06-30
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbols", type=str, nargs="+", required=True)
+    parser.add_argument("--index", type=str, default="sh000300")
+    parser.add_argument("--cache_dir", type=str, default="D:/Qingyu/Repos/stock/cache")
+    parser.add_argument("--start", type=str, required=True)
+    parser.add_argument("--end", type=str, required=True)
+    parser.add_argument("--cash", type=float, default=1000000)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    if not os.path.isdir(args.cache_dir):
+        os.mkdir(args.cache_dir)
+        print("=" * 80)
+        print("mkdir => %s" % args.cache_dir)
+
+    time_start = time.perf_counter()
+    bars = load_bars(args.symbols, args.index, args.cache_dir)
+    print("Load Bars (%d symbols): %.2f s" % (len(args.symbols), time.perf_counter() - time_start))
+
+    replay = Replay(bars, ak_to_jq(args.index), args.start, args.end, cash=args.cash,
+                    params={"signal_workers": args.workers})
+    portfolio_final = replay.run()
+    replay.report()
+
+    print("Start Portfolio Value: %.2f" % args.cash)
+    print("Final Portfolio Value: %.2f" % portfolio_final)
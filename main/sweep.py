@@ -0,0 +1,156 @@
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import os
+import time
+from multiprocessing import shared_memory
+
+import backtrader as bt
+import numpy as np
+import pandas as pd
+
+from main.ma_strategy import QuietStrategy
+
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+
+# 工作进程中由共享内存构造的 DataFrame, 每个进程只构造一次
+_feed = {}
+
+
+def share_bars(stock_data):
+    """
+    日期 (按天计的整数) 与 OHLCV 放入一块共享内存, 形状为 (1 + 字段数, 行数)
+    返回 (SharedMemory, shape), 调用方负责 close 及 unlink
+    """
+    shape = (1 + len(FIELDS), len(stock_data))
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+    bars = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    bars[0] = pd.DatetimeIndex(stock_data.index).values.astype("datetime64[D]").astype(np.int64)
+    for i, field in enumerate(FIELDS):
+        bars[1+i] = stock_data[field].values
+    return shm, shape
+
+
+def attach_bars(name, shape):
+    """
+    工作进程初始化: 映射共享内存并构造不复制数据的 DataFrame
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    bars = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    index = pd.DatetimeIndex(bars[0].astype(np.int64).astype("datetime64[D]"), name="date")
+    _feed["shm"] = shm
+    _feed["frame"] = pd.DataFrame(dict(zip(FIELDS, bars[1:])), index=index, copy=False)
+    return
+
+
+def run_params(params, date_start, date_final, cash=10000):
+    """
+    在工作进程中用共享的日线运行一组参数, 返回结果表的一行
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.addstrategy(QuietStrategy, **params)
+    data = bt.feeds.PandasData(
+        dataname=_feed["frame"],
+        fromdate=date_start,
+        todate=date_final
+    )
+    cerebro.adddata(data)
+
+    cerebro.broker.setcash(cash)
+    cerebro.addsizer(bt.sizers.FixedSize, stake=100)
+    cerebro.broker.setcommission(commission=0.002)
+
+    # 默认按年计算, 半年的日线只有一个年度收益, 结果为 None; 改为按日收益计算并年化
+    cerebro.addanalyzer(bt.analyzers.SharpeRatio, _name="SharpeRatio", timeframe=bt.TimeFrame.Days, annualize=True)
+    cerebro.addanalyzer(bt.analyzers.DrawDown, _name="DW")
+
+    strategy = cerebro.run()[0]
+    row = dict(params)
+    row["final_value"] = cerebro.broker.getvalue()
+    row["sharpe_ratio"] = strategy.analyzers.SharpeRatio.get_analysis().get("sharperatio")
+    row["max_drawdown"] = strategy.analyzers.DW.get_analysis().max.drawdown
+    return row
+
+
+def run_batch(batch, date_start, date_final, cash=10000):
+    return [run_params(params, date_start, date_final, cash) for params in batch]
+
+
+def make_grid(**ranges):
+    """
+    make_grid(maperiod=range(10, 31)) => [{"maperiod": 10}, {"maperiod": 11}, ...]
+    """
+    names = list(ranges)
+    return [dict(zip(names, values)) for values in itertools.product(*ranges.values())]
+
+
+def sweep(stock_data, grid, date_start, date_final, cash=10000, workers=None, batch_size=None):
+    """
+    日线只写入共享内存一次, 参数组分批交给进程池, 汇总为一张按期末市值排序的结果表
+    batch_size: 每次提交的参数组数, 默认使每个进程约分到 4 批
+    """
+    workers = workers or os.cpu_count()
+    batch_size = batch_size or max(1, len(grid) // (workers * 4))
+    batches = [grid[i:i+batch_size] for i in range(0, len(grid), batch_size)]
+
+    shm, shape = share_bars(stock_data)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=attach_bars, initargs=(shm.name, shape)
+        ) as executor:
+            futures = [executor.submit(run_batch, batch, date_start, date_final, cash) for batch in batches]
+            rows = [row for future in futures for row in future.result()]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return pd.DataFrame(rows).sort_values("final_value", ascending=False).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+
+    """
+
+python -m main.sweep --symbol sh600570 --maperiod 10 31
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbol", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, default="D:/Qingyu/Repos/stock/cache")
+    parser.add_argument("--update", action="store_true")
+    parser.add_argument("--maperiod", type=int, nargs=2, default=[10, 31])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # 只在主进程读取日线, 工作进程导入本模块时不加载 akshare
+    from utils.ak import get_ak_stock_zh_a_daily
+
+    if not os.path.isdir(args.cache_dir):
+        os.mkdir(args.cache_dir)
+        print("=" * 80)
+        print("mkdir => %s" % args.cache_dir)
+
+    date_start = datetime.datetime(2020, 1, 1)
+    date_final = datetime.datetime(2020, 6, 29)
+
+    stock_data = get_ak_stock_zh_a_daily(
+        symbol=args.symbol, cache_dir=args.cache_dir, adjust="qfq", update=args.update,
+        fmt="npy", start=date_start, end=date_final
+    )
+    print("Fetch Date (%s)" % args.symbol)
+
+    grid = make_grid(maperiod=range(*args.maperiod))
+
+    time_start = time.perf_counter()
+    results = sweep(stock_data, grid, date_start, date_final, workers=args.workers)
+    elapsed = time.perf_counter() - time_start
+
+    print("=" * 80)
+    print(results.to_string())
+    print("=" * 80)
+    print("Combinations: %d, Workers: %d, %.2f s, %.2f combinations/s" % (
+        len(grid), args.workers, elapsed, len(grid) / max(elapsed, 1e-9)
+    ))
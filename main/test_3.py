@@ -153,7 +153,14 @@ python -m main.test_3 --symbol sh600760
         print("=" * 80)
         print("mkdir => %s" % args.cache_dir)
 
-    stock_data = get_ak_stock_zh_a_daily(symbol=args.symbol, cache_dir=args.cache_dir, adjust="qfq", update=args.update)
+    date_start = datetime.datetime(2020, 3, 1)
+    date_final = datetime.datetime(2020, 6, 29)
+
+    # PandasData 会丢弃 fromdate 之前的bar, 只读取回测区间
+    stock_data = get_ak_stock_zh_a_daily(
+        symbol=args.symbol, cache_dir=args.cache_dir, adjust="qfq", update=args.update,
+        fmt="npy", start=date_start, end=date_final
+    )
     print("Fetch Date (%s)" % args.symbol)
 
     # Main
@@ -161,8 +168,6 @@ python -m main.test_3 --symbol sh600760
 
     cerebro.addstrategy(TestStrategy)
 
-    date_start = datetime.datetime(2020, 3, 1)
-    date_final = datetime.datetime(2020, 6, 29)
     data = bt.feeds.PandasData(
         dataname=stock_data,
         fromdate=date_start,
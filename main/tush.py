@@ -3,57 +3,387 @@ import tushare as ts
 
 ts.set_token('d10eef51b3a3f0d31dafc6d3a94bde10be61b00aa4e1a431ea34cb67')
 
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
 import tushare as ts
 import pymysql
 
 
-def main():
-    # 设置tushare pro的token并获取连接
-    ts.set_token('xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx')
-    pro = ts.pro_api()
-    # 设定获取日线行情的初始日期和终止日期，其中终止日期设定为昨天。
-    start_dt = '20100101'
-    time_temp = datetime.datetime.now() - datetime.timedelta(days=1)
-    end_dt = time_temp.strftime('%Y%m%d')
+# stock_all 表的列, 与 frame_to_records 输出的每行顺序一致
+COLUMNS = ['state_dt', 'stock_code', 'open', 'close', 'high', 'low', 'vol', 'amount', 'pre_close', 'amt_change', 'pct_change']
+
+# 参数占位符
+PLACEHOLDER = {'mysql': '%s', 'sqlite': '?'}
 
-    # 建立数据库连接,剔除已入库的部分
-    db = pymysql.connect(host='127.0.0.1', user='root', passwd='admin', db='stock', charset='utf8')
+
+def frame_to_records(df):
+    """
+    pro.daily 返回的 DataFrame 转为按日期升序的参数元组列表, 列顺序同 COLUMNS, nan 记为 -1
+    整表向量化转换, 不逐行处理
+    """
+    df = df.sort_values('trade_date')
+    records = pd.DataFrame({
+        'state_dt': pd.to_datetime(df['trade_date'], format='%Y%m%d').dt.strftime('%Y-%m-%d'),
+        'stock_code': df['ts_code'].astype(str),
+        'open': df['open'],
+        'close': df['close'],
+        'high': df['high'],
+        'low': df['low'],
+        'vol': df['vol'].fillna(-1).astype(np.int64),
+        'amount': df['amount'],
+        'pre_close': df['pre_close'],
+        'amt_change': df['change'],
+        'pct_change': df['pct_chg'],
+    }, columns=COLUMNS)
+    prices = [column for column in COLUMNS if column not in ('state_dt', 'stock_code', 'vol')]
+    records[prices] = records[prices].astype(float).fillna(-1).round(2)
+    return records.to_records(index=False).tolist()
+
+
+def get_unique_keys(cursor, dialect='mysql'):
+    """
+    stock_all 上的唯一索引 (含主键) {索引名: 列集合}
+    """
+    keys = {}
+    if dialect == 'sqlite':
+        cursor.execute("PRAGMA index_list(stock_all)")
+        for _, name, unique in [row[:3] for row in cursor.fetchall()]:
+            if unique:
+                cursor.execute("PRAGMA index_info(%s)" % name)
+                keys[name] = {row[2] for row in cursor.fetchall()}
+    else:
+        # (Table, Non_unique, Key_name, Seq_in_index, Column_name, ...)
+        cursor.execute("SHOW INDEX FROM stock_all")
+        for row in cursor.fetchall():
+            if int(row[1]) == 0:
+                keys.setdefault(row[2], set()).add(row[4])
+    return keys
+
+
+def ensure_table(db, dialect='mysql'):
+    """
+    建表 (不存在时), 并保证 (stock_code, state_dt) 唯一, 重复写入同一天的数据变为更新
+    已有该两列的唯一索引或主键时不再新建; 新建失败 (如表中已有重复行) 时抛出异常
+    """
     cursor = db.cursor()
+    try:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS stock_all(state_dt varchar(45), stock_code varchar(45), open decimal(20,2), "
+            "close decimal(20,2), high decimal(20,2), low decimal(20,2), vol int(20), amount decimal(30,2), "
+            "pre_close decimal(20,2), amt_change decimal(20,2), pct_change decimal(20,2))"
+        )
+        if {'stock_code', 'state_dt'} not in get_unique_keys(cursor, dialect).values():
+            if dialect == 'sqlite':
+                cursor.execute("CREATE UNIQUE INDEX uk_code_dt ON stock_all(stock_code, state_dt)")
+            else:
+                cursor.execute("ALTER TABLE stock_all ADD UNIQUE KEY uk_code_dt (stock_code, state_dt)")
+        db.commit()
+    finally:
+        cursor.close()
+    return
+
+
+def get_latest_dates(db):
+    """
+    每只股票已入库的最后日期 {stock_code: 'YYYY-MM-DD'}
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT stock_code, MAX(state_dt) FROM stock_all GROUP BY stock_code")
+    latest = dict(cursor.fetchall())
+    cursor.close()
+    return latest
+
+
+def upsert_records(db, records, batch_size=1000, dialect='mysql'):
+    """
+    executemany 分批写入, 每批一个事务
+    已存在的 (stock_code, state_dt) 更新为新值, 重复运行结果不变, 返回写入的行数
+    """
+    placeholder = PLACEHOLDER[dialect]
+    updates = [column for column in COLUMNS if column not in ('state_dt', 'stock_code')]
+    sql_upsert = "INSERT INTO stock_all(%s) VALUES (%s)" % (','.join(COLUMNS), ','.join([placeholder] * len(COLUMNS)))
+    if dialect == 'sqlite':
+        sql_upsert += " ON CONFLICT(stock_code, state_dt) DO UPDATE SET " + ','.join(
+            '%s=excluded.%s' % (column, column) for column in updates
+        )
+    else:
+        sql_upsert += " ON DUPLICATE KEY UPDATE " + ','.join('%s=VALUES(%s)' % (column, column) for column in updates)
+
+    cursor = db.cursor()
+    try:
+        for i in range(0, len(records), batch_size):
+            cursor.executemany(sql_upsert, records[i:i+batch_size])
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(records)
+
+
+def load_checkpoint(checkpoint, end_dt):
+    """
+    断点: 本次 (end_dt 相同) 已完成的股票, 中断后重新运行时跳过
+    """
+    if checkpoint and os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        if state.get('end_dt') == end_dt:
+            return set(state['done'])
+    return set()
+
+
+def save_checkpoint(checkpoint, end_dt, done):
+    if not checkpoint:
+        return
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump({'end_dt': end_dt, 'done': sorted(done)}, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+    return
+
+
+def get_start_dt(latest, code, start_dt):
+    """
+    已入库的股票从最后日期的下一天开始请求
+    """
+    if code not in latest:
+        return start_dt
+    next_dt = datetime.datetime.strptime(latest[code], '%Y-%m-%d') + datetime.timedelta(days=1)
+    return max(start_dt, next_dt.strftime('%Y%m%d'))
+
+
+def split_windows(start_dt, end_dt, window_days=1825):
+    """
+    [start_dt, end_dt] 按 window_days 天切分为多个日期窗口 [('YYYYMMDD', 'YYYYMMDD'), ...], 单次请求不超过接口行数上限
+    """
+    windows = []
+    window_start = datetime.datetime.strptime(start_dt, '%Y%m%d')
+    final = datetime.datetime.strptime(end_dt, '%Y%m%d')
+    while window_start <= final:
+        window_end = min(window_start + datetime.timedelta(days=window_days-1), final)
+        windows.append((window_start.strftime('%Y%m%d'), window_end.strftime('%Y%m%d')))
+        window_start = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+def fetch_windows(pro, code, start_dt, end_dt, window_days=1825, workers=4, retries=3, backoff=1.0):
+    """
+    分窗口请求 pro.daily, 最多 workers 个窗口同时请求, 失败的窗口按 backoff * 2^n 秒退避后单独重试
+    合并去重后按日期升序返回; 重试 retries 次后仍有失败的窗口时抛出最后的异常
+    """
+    pending = split_windows(start_dt, end_dt, window_days)
+    frames = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2 ** (attempt-1))
+            futures = {
+                executor.submit(pro.daily, ts_code=code, start_date=window[0], end_date=window[1]): window
+                for window in pending
+            }
+            pending, error = [], None
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    frames[futures[future]] = future.result()
+                except Exception as err:
+                    pending.append(futures[future])
+                    error = err
+            if not pending:
+                break
+        else:
+            raise error
+
+    df = pd.concat([frames[window] for window in sorted(frames)], ignore_index=True)
+    df = df.drop_duplicates(subset=['ts_code', 'trade_date'], keep='last')
+    return df.sort_values('trade_date').reset_index(drop=True)
+
+
+def ingest(pro, db, stock_pool, start_dt, end_dt, batch_size=1000, dialect='mysql', checkpoint=None,
+           window_days=1825, window_workers=4):
+    """
+    增量获取日线并写入 stock_all, 打印进度及写入速度, 返回写入的总行数
+    每只股票从已入库的最后日期的下一天开始请求; checkpoint 为断点文件路径, 记录已完成的股票
+    window_days, window_workers: 分窗口请求的窗口天数及并发数, 见 fetch_windows
+    """
+    ensure_table(db, dialect)
+    latest = get_latest_dates(db)
+    done = load_checkpoint(checkpoint, end_dt)
 
-    # 设定需要获取数据的股票池
-    stock_pool = ['603912.SH','300666.SZ','300618.SZ','002049.SZ','300672.SZ']
     total = len(stock_pool)
+    rows = 0
+    time_start = time.perf_counter()
 
     # 循环获取单个股票的日线行情
     for i in range(len(stock_pool)):
+        code = stock_pool[i]
+        if code in done:
+            continue
+
+        # 剔除已入库的部分
+        code_start_dt = get_start_dt(latest, code, start_dt)
+
         try:
-            df = pro.daily(ts_code=stock_pool[i], start_date=start_dt, end_date=end_dt)
+            if code_start_dt <= end_dt:
+                df = fetch_windows(pro, code, code_start_dt, end_dt, window_days=window_days, workers=window_workers)
+                rows += upsert_records(db, frame_to_records(df), batch_size=batch_size, dialect=dialect)
             # 打印进度
-            print('Seq: ' + str(i+1) + ' of ' + str(total) + '   Code: ' + str(stock_pool[i]))
-            c_len = df.shape[0]
+            print('Seq: ' + str(i+1) + ' of ' + str(total) + '   Code: ' + str(code))
         except Exception as aa:
             print(aa)
             print('No DATA Code: ' + str(i))
             continue
-        for j in range(c_len):
-            resu0 = list(df.ix[c_len-1-j])
-            resu = []
-            for k in range(len(resu0)):
-                if str(resu0[k]) == 'nan':
-                    resu.append(-1)
-                else:
-                    resu.append(resu0[k])
-            state_dt = (datetime.datetime.strptime(resu[1], "%Y%m%d")).strftime('%Y-%m-%d')
+
+        done.add(code)
+        save_checkpoint(checkpoint, end_dt, done)
+
+    elapsed = time.perf_counter() - time_start
+    print('Rows: %d, %.2f s, %.2f rows/s' % (rows, elapsed, rows / max(elapsed, 1e-9)))
+    return rows
+
+
+class ConnectionPool(object):
+    """
+    固定大小的数据库连接池, connect 为创建连接的函数
+    """
+
+    def __init__(self, connect, size):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(connect())
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self.connections.get()
+        try:
+            yield db
+        finally:
+            self.connections.put(db)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+        return
+
+
+def ingest_concurrent(pro, connect, stock_pool, start_dt, end_dt, fetchers=4, writers=2, batch_size=1000,
+                      dialect='mysql', checkpoint=None, queue_size=16, window_days=1825, window_workers=1):
+    """
+    并发增量入库: fetchers 个线程请求日线 => 有界队列 => writers 个线程经连接池写入
+    每只股票分窗口请求, 同时进行的请求数为 fetchers * window_workers
+    每只股票的数据由一个写入线程在一个批次序列中按日期顺序写入; 队列满时请求线程等待
+    返回每只股票的状态 {stock_code: 'ok' / 'skipped' / 错误信息}
+    """
+    pool = ConnectionPool(connect, writers)
+    with pool.connection() as db:
+        ensure_table(db, dialect)
+        latest = get_latest_dates(db)
+    done = load_checkpoint(checkpoint, end_dt)
+
+    status = {}
+    codes = queue.Queue()
+    for code in stock_pool:
+        code_start_dt = get_start_dt(latest, code, start_dt)
+        if code in done or code_start_dt > end_dt:
+            status[code] = 'skipped'
+        else:
+            codes.put((code, code_start_dt))
+    frames = queue.Queue(maxsize=queue_size)
+
+    lock = threading.Lock()
+    total = codes.qsize()
+    progress = {'count': 0, 'rows': 0}
+    time_start = time.perf_counter()
+
+    def finish(code, err=None, rows=0):
+        with lock:
+            progress['count'] += 1
+            progress['rows'] += rows
+            if err is None:
+                status[code] = 'ok'
+                done.add(code)
+                save_checkpoint(checkpoint, end_dt, done)
+            else:
+                status[code] = repr(err)
+            elapsed = time.perf_counter() - time_start
+            # 打印进度
+            print('Seq: %d of %d   Code: %s   %s   %.2f rows/s' % (
+                progress['count'], total, code, status[code], progress['rows'] / max(elapsed, 1e-9)
+            ))
+        return
+
+    def fetch_worker():
+        while True:
+            try:
+                code, code_start_dt = codes.get_nowait()
+            except queue.Empty:
+                return
             try:
-                sql_insert = "INSERT INTO stock_all(state_dt,stock_code,open,close,high,low,vol,amount,pre_close,amt_change,pct_change) VALUES ('%s', '%s', '%.2f', '%.2f','%.2f','%.2f','%i','%.2f','%.2f','%.2f','%.2f')" % (state_dt,str(resu[0]),float(resu[2]),float(resu[5]),float(resu[3]),float(resu[4]),float(resu[9]),float(resu[10]),float(resu[6]),float(resu[7]),float(resu[8]))
-                cursor.execute(sql_insert)
-                db.commit()
+                df = fetch_windows(pro, code, code_start_dt, end_dt, window_days=window_days, workers=window_workers)
+                frames.put((code, frame_to_records(df)))
             except Exception as err:
-                continue
+                finish(code, err)
+
+    def write_worker():
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            code, records = item
+            try:
+                with pool.connection() as db:
+                    rows = upsert_records(db, records, batch_size=batch_size, dialect=dialect)
+                finish(code, rows=rows)
+            except Exception as err:
+                finish(code, err)
+
+    fetch_threads = [threading.Thread(target=fetch_worker) for _ in range(fetchers)]
+    write_threads = [threading.Thread(target=write_worker) for _ in range(writers)]
+    for thread in fetch_threads + write_threads:
+        thread.start()
+    for thread in fetch_threads:
+        thread.join()
+    for _ in write_threads:
+        frames.put(None)
+    for thread in write_threads:
+        thread.join()
+    pool.close()
+
+    elapsed = time.perf_counter() - time_start
+    failed = [code for code in stock_pool if status[code] not in ('ok', 'skipped')]
+    print('Symbols: %d, Failed: %d, Rows: %d, %.2f s, %.2f symbols/s, %.2f rows/s' % (
+        total, len(failed), progress['rows'], elapsed, total / max(elapsed, 1e-9), progress['rows'] / max(elapsed, 1e-9)
+    ))
+    return {code: status[code] for code in stock_pool}
+
+
+def main():
+    # 设置tushare pro的token并获取连接
+    ts.set_token('xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx')
+    pro = ts.pro_api()
+    # 设定获取日线行情的初始日期和终止日期，其中终止日期设定为昨天。
+    start_dt = '20100101'
+    time_temp = datetime.datetime.now() - datetime.timedelta(days=1)
+    end_dt = time_temp.strftime('%Y%m%d')
+
+    # 数据库连接池, 剔除已入库的部分
+    connect = functools.partial(pymysql.connect, host='127.0.0.1', user='root', passwd='admin', db='stock', charset='utf8')
+
+    # 设定需要获取数据的股票池
+    stock_pool = ['603912.SH','300666.SZ','300618.SZ','002049.SZ','300672.SZ']
+
+    ingest_concurrent(pro, connect, stock_pool, start_dt, end_dt, checkpoint='tush_checkpoint.json')
 
-    cursor.close()
-    db.close()
     print('All Finished!')
 
 
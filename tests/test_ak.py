@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('akshare')
+
+from utils import ak as ak_cache
+from utils.ak import get_ak_stock_zh_a_daily
+
+
+class FakeFetch(object):
+    """
+    ak.stock_zh_a_daily 替身: 返回 frame 中 [start_date, end_date] 的行, 记录每次请求的 start_date
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.calls = []
+
+    def __call__(self, symbol, adjust=None, start_date=None, end_date=None):
+        self.calls.append(start_date)
+        frame = self.frame
+        if start_date is not None:
+            frame = frame[frame.index >= pd.Timestamp(start_date)]
+        if end_date is not None:
+            frame = frame[frame.index <= pd.Timestamp(end_date)]
+        return frame.copy()
+
+
+def make_daily(rows, scale=1.):
+    # npy 缓存按 datetime64[ns] 保存日期
+    dates = pd.bdate_range('2020-01-01', periods=rows, name='date').astype('datetime64[ns]')
+    close = np.round(10 * np.exp(np.cumsum(np.random.default_rng(0).normal(0, 0.02, rows))), 2) * scale
+    return pd.DataFrame({'open': close, 'high': close * 1.01, 'low': close * 0.99, 'close': close, 'volume': 1e6}, index=dates)
+
+
+@pytest.fixture
+def manifest_calls(monkeypatch):
+    calls = []
+    put, touch = ak_cache.Manifest.put, ak_cache.Manifest.touch
+
+    def record_put(self, *args, **kwargs):
+        calls.append('put')
+        return put(self, *args, **kwargs)
+
+    def record_touch(self, *args, **kwargs):
+        calls.append('touch')
+        return touch(self, *args, **kwargs)
+
+    monkeypatch.setattr(ak_cache.Manifest, 'put', record_put)
+    monkeypatch.setattr(ak_cache.Manifest, 'touch', record_touch)
+    return calls
+
+
+def load(cache_dir, fetch, fmt, update=True):
+    return get_ak_stock_zh_a_daily(
+        'sh600570', str(cache_dir), update=update, fmt=fmt, incremental=True, fetch=fetch
+    )
+
+
+@pytest.mark.parametrize('fmt', ['pkl', 'npy'])
+def test_incremental_appends_new_rows(tmp_path, fmt):
+    fetch = FakeFetch(make_daily(80))
+    load(tmp_path, fetch, fmt, update=False)
+
+    fetch.frame = make_daily(100)
+    stock_data = load(tmp_path, fetch, fmt)
+
+    # 第二次只请求缓存最后几个交易日之后的数据
+    assert fetch.calls[0] is None and fetch.calls[1] is not None and len(fetch.calls) == 2
+    pd.testing.assert_frame_equal(stock_data, fetch.frame, check_freq=False)
+
+
+@pytest.mark.parametrize('fmt', ['pkl', 'npy'])
+def test_incremental_no_change_only_touches(tmp_path, fmt, manifest_calls):
+    fetch = FakeFetch(make_daily(80))
+    load(tmp_path, fetch, fmt, update=False)
+    del manifest_calls[:]
+
+    stock_data = load(tmp_path, fetch, fmt)
+
+    assert manifest_calls == ['touch']
+    assert len(fetch.calls) == 2 and fetch.calls[1] is not None
+    pd.testing.assert_frame_equal(stock_data, fetch.frame, check_freq=False)
+
+
+@pytest.mark.parametrize('fmt', ['pkl', 'npy'])
+def test_incremental_checksum_mismatch_refetches(tmp_path, fmt):
+    fetch = FakeFetch(make_daily(80))
+    load(tmp_path, fetch, fmt, update=False)
+
+    # 复权因子变化: 历史价格整体改变
+    fetch.frame = make_daily(100, scale=0.5)
+    stock_data = load(tmp_path, fetch, fmt)
+
+    assert fetch.calls[1] is not None and fetch.calls[2] is None and len(fetch.calls) == 3
+    pd.testing.assert_frame_equal(stock_data, fetch.frame, check_freq=False)
+
+
+@pytest.mark.parametrize('fmt', ['pkl', 'npy'])
+def test_incremental_empty_cache_refetches(tmp_path, fmt):
+    fetch = FakeFetch(make_daily(0))
+    load(tmp_path, fetch, fmt, update=False)
+
+    fetch.frame = make_daily(20)
+    stock_data = load(tmp_path, fetch, fmt)
+
+    assert fetch.calls == [None, None]
+    pd.testing.assert_frame_equal(stock_data, fetch.frame, check_freq=False)
@@ -0,0 +1,92 @@
+import numpy as np
+
+from main import alligator_indicator
+from main.alligator_indicator import (
+    calculate_ma, calculate_sma, calculate_sma_series, create_ma, is_sleeping_series
+)
+
+
+def check_sleeping_loop(close, nday, threshold=0.02):
+    """
+    原有 check_sleeping 的逐日循环, 作为对照
+    """
+    for day in range(nday):
+        ma_b = calculate_sma(close, n=13, m=8)
+        ma_r = calculate_sma(close, n=8,  m=5)
+        ma_g = calculate_sma(close, n=5,  m=3)
+        if abs(ma_b/ma_r-1) < threshold and abs(ma_r/ma_g-1) < threshold:
+            return True
+        close = close[:-1]
+    return False
+
+
+def make_close(seed, size=50, volatility=0.01):
+    """
+    随机游走收盘价, 前面随机个数的bar为nan (模拟上市前的补齐)
+    """
+    rng = np.random.default_rng(seed)
+    close = np.round(10 * np.exp(np.cumsum(rng.normal(0, volatility, size))), 2)
+    close[:rng.integers(0, size-20)] = np.nan
+    return close
+
+
+def test_calculate_sma_series_nan_prefix():
+    for seed in range(50):
+        close = make_close(seed)
+        for n, m in ((13, 8), (8, 5), (5, 3)):
+            sma = calculate_sma_series(close, n, m)
+            assert np.isnan(sma[:n-1+m]).all()
+            for t in range(n-1+m, len(close)):
+                expected = calculate_sma(close[:t+1], n, m)
+                assert sma[t] == expected or (np.isnan(sma[t]) and np.isnan(expected))
+
+
+def test_is_sleeping_series_matches_loop():
+    results = []
+    for seed in range(200):
+        close = make_close(seed, volatility=0.01 if seed % 2 else 0.03)
+        expected = check_sleeping_loop(close, nday=20)
+        assert bool(is_sleeping_series(close, nday=20)) == expected
+        results.append(expected)
+    # 对照中两种结果都出现, 检查才有意义
+    assert any(results) and not all(results)
+
+
+def test_scan_sleeping_matches_per_stock(monkeypatch):
+    # 平台接口的替身: 每只股票一条收盘价, 部分股票前面为nan
+    closes = {'%06d.XSHE' % seed: make_close(seed, volatility=0.01 if seed % 2 else 0.03) for seed in range(100)}
+    closes['000100.XSHE'] = np.full(50, np.nan)
+
+    def history(count, unit, field, security_list, df):
+        return {stock: closes[stock][-count:] for stock in security_list}
+
+    def attribute_history(security, count, unit, fields, df):
+        return {fields: closes[security][-count:]}
+
+    monkeypatch.setattr(alligator_indicator, 'history', history, raising=False)
+    monkeypatch.setattr(alligator_indicator, 'attribute_history', attribute_history, raising=False)
+
+    stock_list = sorted(closes)
+    expected = [stock for stock in stock_list if alligator_indicator.check_sleeping(stock, nday=20)]
+    assert alligator_indicator.scan_sleeping(stock_list, nday=20) == expected
+    assert expected == [stock for stock in stock_list if check_sleeping_loop(closes[stock], nday=20)]
+    # nan补齐的股票中也有沉睡的
+    assert any(np.isnan(closes[stock]).any() for stock in expected)
+
+
+def test_calculate_ma_streaming_matches_window():
+    for seed in range(20):
+        close = make_close(seed)
+        for mode, n, m in (('sma', 5, 8), ('sma', 13, 8), ('smma', 8, 5)):
+            ma = create_ma(n, m, mode)
+            for t in range(len(close)):
+                value = calculate_ma(close[:t+1], n, m, mode, ma=ma)
+                # 不足n+m根时按窗口计算的结果为部分窗口的均值, 不比较
+                if t < n-1+m: continue
+                expected = calculate_ma(close[:t+1], n, m, mode)
+                assert np.isclose(value, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_streaming_sma_nan_leaves_window():
+    ma = create_ma(5, 0, 'sma', price=[np.nan] * 3 + [1., 2., 3., 4., 5.])
+    assert ma.value == calculate_sma(np.array([1., 2., 3., 4., 5.]), 5)
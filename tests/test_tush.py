@@ -0,0 +1,76 @@
+import threading
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('tushare')
+pytest.importorskip('pymysql')
+
+from main.tush import fetch_windows, split_windows
+
+
+class FakePro(object):
+    """
+    pro_api 替身: daily 按交易日 (工作日) 降序返回 [start_date - overlap, end_date] 的日线
+    failures: {start_date: 次数}, 该窗口的前若干次请求抛出 IOError
+    """
+
+    def __init__(self, failures=None, overlap=0):
+        self.failures = dict(failures or {})
+        self.overlap = overlap
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def daily(self, ts_code, start_date, end_date):
+        with self.lock:
+            self.calls.append((start_date, end_date))
+            if self.failures.get(start_date, 0) > 0:
+                self.failures[start_date] -= 1
+                raise IOError('timeout %s' % start_date)
+        start = pd.Timestamp(start_date) - pd.offsets.BDay(self.overlap)
+        dates = pd.bdate_range(start, end_date).strftime('%Y%m%d')[::-1]
+        return pd.DataFrame({'ts_code': ts_code, 'trade_date': dates, 'close': 1.})
+
+
+def test_split_windows():
+    assert split_windows('20200101', '20200110', window_days=5) == [
+        ('20200101', '20200105'), ('20200106', '20200110')
+    ]
+    # 最后一个窗口只剩一天
+    assert split_windows('20200101', '20200111', window_days=5)[-1] == ('20200111', '20200111')
+    # 区间短于窗口
+    assert split_windows('20200101', '20200103', window_days=5) == [('20200101', '20200103')]
+    assert split_windows('20200101', '20200101', window_days=5) == [('20200101', '20200101')]
+
+
+def test_split_windows_empty():
+    assert split_windows('20200102', '20200101') == []
+
+
+def test_fetch_windows_retries_failed_windows_only():
+    pro = FakePro(failures={'20200106': 1})
+    df = fetch_windows(pro, '600570.SH', '20200101', '20200120', window_days=5, backoff=0)
+
+    windows = split_windows('20200101', '20200120', window_days=5)
+    assert sorted(pro.calls[:len(windows)]) == windows
+    assert pro.calls[len(windows):] == [('20200106', '20200110')]
+    assert list(df.trade_date) == list(pd.bdate_range('20200101', '20200120').strftime('%Y%m%d'))
+
+
+def test_fetch_windows_raises_after_retries():
+    pro = FakePro(failures={'20200106': 10})
+    with pytest.raises(IOError):
+        fetch_windows(pro, '600570.SH', '20200101', '20200120', window_days=5, retries=2, backoff=0)
+
+    assert pro.calls.count(('20200106', '20200110')) == 3
+
+
+def test_fetch_windows_deduplicated_and_sorted():
+    # 每个窗口多返回前一个交易日, 与上一个窗口重叠
+    pro = FakePro(overlap=1)
+    df = fetch_windows(pro, '600570.SH', '20200101', '20200331', window_days=10, backoff=0)
+
+    assert not df.duplicated(subset=['ts_code', 'trade_date']).any()
+    assert df.trade_date.is_monotonic_increasing
+    assert list(df.trade_date) == list(pd.bdate_range('20191231', '20200331').strftime('%Y%m%d'))
+    assert list(df.index) == list(range(len(df)))
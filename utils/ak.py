@@ -1,14 +1,488 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import json
 import os
+import shutil
+import threading
+import time
 
 import akshare as ak
+import numpy as np
 import pandas as pd
 
+from utils.store import Store, write_store
 
-def get_ak_stock_zh_a_daily(symbol, cache_dir, adjust=None, update=False):
-    cache_path = "%s/ak_stock_zh_a_daily-%s.pkl" % (cache_dir, symbol)
-    if os.path.isfile(cache_path) and not update:
-        stock_data = pd.read_pickle(cache_path)
+
+def replace_file(path, write):
+    """
+    先写临时文件再替换, 读者不会读到写了一半的文件
+    Windows 下目标文件正被内存映射时替换会失败 (PermissionError), 需要内存映射的文件见 save_columns
+    """
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+    return
+
+
+def save_columns(stock_data, column_dir, keep=2):
+    """
+    按列保存: date.npy 为日期索引, values.npy 为 (列 x 行) 的数值矩阵, columns.txt 为列名
+    每列在 values.npy 中连续存放, 读取时可按列内存映射
+
+    每次保存写入新的版本目录 column_dir/<版本>/, 写完后替换 column_dir/CURRENT 指向新版本
+    不覆盖旧文件: 已内存映射旧版本的读者不受影响, Windows 下也不会因文件被映射而替换失败
+    只保留最近 keep 个版本, 仍被映射而删除失败的旧版本留到下次保存时再删
+    """
+    os.makedirs(column_dir, exist_ok=True)
+    version = "%d" % time.time_ns()
+    version_dir = "%s/%s" % (column_dir, version)
+    os.makedirs(version_dir)
+
+    dates = pd.DatetimeIndex(stock_data.index).values.astype("datetime64[ns]")
+    values = np.ascontiguousarray(stock_data.values.T, dtype=float)
+    np.save("%s/values.npy" % version_dir, values)
+    np.save("%s/date.npy" % version_dir, dates)
+    with open("%s/columns.txt" % version_dir, "w") as f:
+        f.write("\n".join(stock_data.columns))
+    replace_file("%s/CURRENT" % column_dir, lambda f: f.write(version.encode()))
+
+    versions = sorted((name for name in os.listdir(column_dir) if name.isdigit()), key=int)
+    for name in versions[:-keep]:
+        shutil.rmtree("%s/%s" % (column_dir, name), ignore_errors=True)
+    return
+
+
+def get_column_version(column_dir):
+    """
+    CURRENT 指向的版本目录, 没有 CURRENT 时为旧格式, 文件直接存放在 column_dir 下
+    """
+    if not os.path.isfile("%s/CURRENT" % column_dir):
+        return column_dir
+    with open("%s/CURRENT" % column_dir) as f:
+        return "%s/%s" % (column_dir, f.read().strip())
+
+
+def date_range(dates, start=None, end=None, warmup=0):
+    """
+    [start, end] 区间在已排序日期数组中的 slice, 向前多取 warmup 根bar供指标预热
+    """
+    first, last = 0, len(dates)
+    if start is not None:
+        first = np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), side="left")
+    if end is not None:
+        last = np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), side="right")
+    return slice(max(0, first - warmup), last)
+
+
+def load_columns(column_dir, columns=None, df=True, start=None, end=None, warmup=0):
+    """
+    内存映射读取 save_columns 保存的列, 不复制数据, columns 为空时读取全部列
+    df=False 时返回 (日期数组, {列名: 数组}), 省去构造 DataFrame 的开销
+    start, end, warmup: 只读取该日期区间 (及之前 warmup 根bar) 的行
+    """
+    column_dir = get_column_version(column_dir)
+    with open("%s/columns.txt" % column_dir) as f:
+        names = f.read().split("\n")
+    if columns is None:
+        columns = names
+    dates = np.load("%s/date.npy" % column_dir, mmap_mode="r")
+    values = np.load("%s/values.npy" % column_dir, mmap_mode="r")
+    rows = date_range(dates, start, end, warmup)
+    dates = dates[rows]
+    data = {column: values[names.index(column), rows] for column in columns}
+    if not df:
+        return dates, data
+    return pd.DataFrame(data, index=pd.DatetimeIndex(dates, name="date"), copy=False)
+
+
+def get_cache_path(symbol, cache_dir, fmt="pkl", adjust=None):
+    """
+    文件名包含复权方式, 不同复权的数据分开缓存
+    """
+    if fmt == "npy":
+        return "%s/ak_stock_zh_a_daily-%s-%s" % (cache_dir, symbol, adjust or "none")
+    return "%s/ak_stock_zh_a_daily-%s-%s.pkl" % (cache_dir, symbol, adjust or "none")
+
+
+def read_cache(cache_path, fmt="pkl", columns=None, df=True, start=None, end=None, warmup=0):
+    if fmt == "npy":
+        return load_columns(cache_path, columns, df, start, end, warmup)
+    stock_data = pd.read_pickle(cache_path)
+    if start is not None or end is not None:
+        stock_data = stock_data.iloc[date_range(pd.DatetimeIndex(stock_data.index).values, start, end, warmup)]
+    if columns is not None:
+        stock_data = stock_data[columns]
+    return stock_data
+
+
+def write_cache(stock_data, cache_path, fmt="pkl"):
+    if fmt == "npy":
+        save_columns(stock_data, cache_path)
+    else:
+        replace_file(cache_path, lambda f: stock_data.to_pickle(f))
+    return
+
+
+def checksum(stock_data, dates):
+    """
+    dates 对应行的价格校验和, 前复权因子变化时历史价格会整体改变
+    """
+    prices = stock_data.loc[dates, ["open", "high", "low", "close"]].values
+    return hashlib.md5(np.round(prices.astype(float), 4).tobytes()).hexdigest()
+
+
+class Manifest(object):
+    """
+    cache_dir/manifest.json: 每个缓存文件的 symbol, adjust, 首末日期, 行数, 校验和及请求时间
+    缓存命中, 新鲜度检查和批量刷新计划都只查 manifest, 不读取数据
+
+    batch() 内的修改在退出时统一写入, 批量读取时不必每只股票重写一次
+    """
+
+    def __init__(self, cache_dir):
+        self.path = "%s/manifest.json" % cache_dir
+        self.lock = threading.RLock()
+        self.deferred = 0
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def get(self, cache_path):
+        """
+        缓存文件被删除时视为未命中
+        """
+        entry = self.entries.get(os.path.basename(cache_path))
+        if entry is None or not os.path.exists(cache_path):
+            return None
+        return entry
+
+    def put(self, cache_path, symbol, adjust, stock_data, fetched_at=None):
+        index = pd.DatetimeIndex(stock_data.index)
+        entry = {
+            "symbol": symbol,
+            "adjust": adjust,
+            "first_date": index[0].strftime("%Y-%m-%d") if len(index) else None,
+            "last_date": index[-1].strftime("%Y-%m-%d") if len(index) else None,
+            "rows": len(index),
+            "checksum": checksum(stock_data, stock_data.index),
+            "fetched_at": fetched_at or datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        with self.lock:
+            self.entries[os.path.basename(cache_path)] = entry
+            self.save()
+        return
+
+    def touch(self, cache_path):
+        with self.lock:
+            self.entries[os.path.basename(cache_path)]["fetched_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+            self.save()
+        return
+
+    def save(self, force=False):
+        with self.lock:
+            if self.deferred and not force:
+                return
+            content = json.dumps(self.entries, indent=1, sort_keys=True).encode()
+            replace_file(self.path, lambda f: f.write(content))
+        return
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.deferred += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.deferred -= 1
+                self.save()
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(cache_dir):
+    """
+    同一进程内每个 cache_dir 共享一个 Manifest
+    """
+    key = os.path.abspath(cache_dir)
+    with _manifests_lock:
+        if key not in _manifests:
+            _manifests[key] = Manifest(cache_dir)
+        return _manifests[key]
+
+
+def plan_refresh(symbols, cache_dir, adjust=None, fmt="pkl", last_date=None):
+    """
+    只查 manifest 给出批量刷新计划: {"missing": 无缓存, "stale": 最后日期早于 last_date, "fresh": 无需刷新}
+    last_date: 预期的最新交易日, 默认为今天或之前最近的工作日
+    """
+    if last_date is None:
+        last_date = np.busday_offset(np.datetime64(datetime.date.today(), "D"), 0, roll="backward")
+    last_date = pd.Timestamp(last_date).strftime("%Y-%m-%d")
+
+    manifest = get_manifest(cache_dir)
+    plan = {"missing": [], "stale": [], "fresh": []}
+    for symbol in symbols:
+        entry = manifest.get(get_cache_path(symbol, cache_dir, fmt, adjust))
+        if entry is None:
+            plan["missing"].append(symbol)
+        elif entry["last_date"] is None or entry["last_date"] < last_date:
+            plan["stale"].append(symbol)
+        else:
+            plan["fresh"].append(symbol)
+    return plan
+
+
+def fetch_delta(symbol, cached, adjust=None, fetch=None, overlap=5):
+    """
+    只请求缓存最后 overlap 个交易日及之后的数据, 用重叠部分的校验和判断是否需要整体重新请求
+    返回 (stock_data, changed)
+    """
+    fetch = fetch or ak.stock_zh_a_daily
+
+    if len(cached) == 0:
+        # 上次请求返回空表, 没有可比对的重叠部分
+        return fetch(symbol=symbol, adjust=adjust), True
+
+    start_date = cached.index[-min(overlap, len(cached))]
+    end_date = datetime.date.today()
+    delta = fetch(symbol=symbol, adjust=adjust, start_date=start_date.strftime("%Y%m%d"), end_date=end_date.strftime("%Y%m%d"))
+
+    dates = cached.index[cached.index >= start_date].intersection(delta.index)
+    if len(dates) == 0 or checksum(cached, dates) != checksum(delta, dates):
+        # 复权调整导致历史数据变化, 重新请求全部数据
+        return fetch(symbol=symbol, adjust=adjust), True
+
+    delta = delta[delta.index > cached.index[-1]]
+    if len(delta) == 0:
+        return cached, False
+    return pd.concat([cached, delta[cached.columns]]), True
+
+
+def get_ak_stock_zh_a_daily(symbol, cache_dir, adjust=None, update=False, fmt="pkl", columns=None, df=True,
+                            incremental=False, fetch=None, start=None, end=None, warmup=0):
+    """
+    fmt: "pkl" - pandas pickle; "npy" - 按列内存映射 (可只读取 columns 中的列, df=False 时返回数组)
+    start, end, warmup: 只返回该日期区间及之前 warmup 根bar, npy 格式只读取这些行
+    incremental: update 时只请求缓存之后的新数据, 复权变化时才整体重新请求
+    fetch: 数据源, 默认 ak.stock_zh_a_daily
+    是否命中缓存只查 manifest.json, 不读取数据
+    """
+    fetch = fetch or ak.stock_zh_a_daily
+    manifest = get_manifest(cache_dir)
+
+    cache_path = get_cache_path(symbol, cache_dir, fmt, adjust)
+    pickle_path = get_cache_path(symbol, cache_dir, "pkl", adjust)
+
+    if manifest.get(cache_path) is not None and not update:
+        return read_cache(cache_path, fmt, columns, df, start, end, warmup)
+
+    if manifest.get(cache_path) is not None and incremental:
+        stock_data, changed = fetch_delta(symbol, read_cache(cache_path, fmt), adjust=adjust, fetch=fetch)
+        if changed:
+            write_cache(stock_data, cache_path, fmt)
+            manifest.put(cache_path, symbol, adjust, stock_data)
+        else:
+            manifest.touch(cache_path)
+    elif fmt == "npy" and manifest.get(pickle_path) is not None and not update:
+        stock_data = pd.read_pickle(pickle_path)
+        write_cache(stock_data, cache_path, fmt)
+        manifest.put(cache_path, symbol, adjust, stock_data, fetched_at=manifest.get(pickle_path)["fetched_at"])
     else:
-        stock_data = ak.stock_zh_a_daily(symbol=symbol, adjust=adjust)
-        stock_data.to_pickle(cache_path)
+        stock_data = fetch(symbol=symbol, adjust=adjust)
+        write_cache(stock_data, cache_path, fmt)
+        manifest.put(cache_path, symbol, adjust, stock_data)
+
+    return read_cache(cache_path, fmt, columns, df, start, end, warmup)
+
+
+class TokenBucket(object):
+    """
+    令牌桶限速: 每秒补充 rate 个令牌, 最多积累 burst 个
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def with_retry(fetch, bucket=None, retries=3, backoff=1.0):
+    """
+    包装数据源: 每次请求前从令牌桶取令牌, 失败后按 backoff * 2^n 秒退避重试
+    """
+    def wrapped(**kwargs):
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                return fetch(**kwargs)
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+    return wrapped
+
+
+def get_ak_stock_zh_a_daily_bulk(symbols, cache_dir, adjust=None, update=False, fmt="pkl", columns=None, df=True,
+                                 incremental=False, fetch=None, workers=8, rate=5.0, burst=5, retries=3, backoff=1.0,
+                                 verbose=True):
+    """
+    批量读取多只股票, 缓存命中直接读取, 未命中的通过线程池并发请求
+    rate, burst: 令牌桶限速 (每秒请求数, 突发上限); retries, backoff: 失败重试次数及退避秒数
+    返回 {symbol: stock_data}, 重试后仍失败的股票不在结果中, 打印吞吐量
+    """
+    fetch = with_retry(fetch or ak.stock_zh_a_daily, TokenBucket(rate, burst), retries, backoff)
+
+    def load(symbol):
+        return get_ak_stock_zh_a_daily(symbol, cache_dir, adjust=adjust, update=update, fmt=fmt, columns=columns,
+                                       df=df, incremental=incremental, fetch=fetch)
+
+    time_start = time.perf_counter()
+    result, failed = {}, {}
+    missing = []
+    manifest = get_manifest(cache_dir)
+    for symbol in symbols:
+        if manifest.get(get_cache_path(symbol, cache_dir, fmt, adjust)) is not None and not update:
+            result[symbol] = load(symbol)
+        else:
+            missing.append(symbol)
+    hits = len(result)
+
+    with manifest.batch(), concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load, symbol): symbol for symbol in missing}
+        for future in concurrent.futures.as_completed(futures):
+            symbol = futures[future]
+            try:
+                result[symbol] = future.result()
+            except Exception as e:
+                failed[symbol] = e
+
+    elapsed = time.perf_counter() - time_start
+    if verbose:
+        print("=" * 80)
+        print("Bulk Load: %d symbols, %d hits, %d fetched, %d failed, %.2f s, %.2f symbols/s" % (
+            len(symbols), hits, len(missing) - len(failed), len(failed), elapsed, len(symbols) / max(elapsed, 1e-9)
+        ))
+        for symbol, e in failed.items():
+            print("Failed => %s: %r" % (symbol, e))
+
+    return {symbol: result[symbol] for symbol in symbols if symbol in result}
+
+
+class FrameCache(object):
+    """
+    进程内 LRU 缓存, 按 DataFrame 占用字节数淘汰, 总量不超过 max_bytes
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.frames = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.frames:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return self.frames[key][0]
+
+    def put(self, key, frame):
+        nbytes = int(frame.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            if key in self.frames:
+                self.nbytes -= self.frames.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                self.nbytes -= self.frames.popitem(last=False)[1][1]
+                self.evictions += 1
+            self.frames[key] = (frame, nbytes)
+            self.nbytes += nbytes
+        return
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.nbytes = 0
+        return
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "frames": len(self.frames), "nbytes": self.nbytes, "max_bytes": self.max_bytes}
+
+
+frame_cache = FrameCache()
+
+
+def load_ak_stock_zh_a_daily(symbol, cache_dir, adjust=None, start=None, end=None, warmup=0, fmt="pkl", cache=None):
+    """
+    经进程内缓存读取 [start, end] 区间 (及之前 warmup 根bar) 的日线, 缓存键为 (cache_dir, fmt, symbol, adjust, start, end, warmup)
+    返回的 DataFrame 在调用方之间共享, 只读使用, 需要修改时先 copy()
+    cache: FrameCache, 默认使用模块级 frame_cache
+    """
+    cache = cache or frame_cache
+
+    key = (os.path.abspath(cache_dir), fmt, symbol, adjust, start, end, warmup)
+    stock_data = cache.get(key)
+    if stock_data is None:
+        stock_data = get_ak_stock_zh_a_daily(symbol, cache_dir, adjust=adjust, fmt=fmt, start=start, end=end, warmup=warmup)
+        if start is not None or end is not None:
+            # 复制区间数据, 不持有整段历史的引用, 占用字节数与缓存计数一致
+            stock_data = stock_data.copy()
+        cache.put(key, stock_data)
     return stock_data
+
+
+def get_store_path(cache_dir, adjust=None):
+    return "%s/ak_stock_zh_a_daily-store-%s" % (cache_dir, adjust or "none")
+
+
+def build_ak_stock_zh_a_daily_store(symbols, cache_dir, adjust=None, store_dir=None, **kwargs):
+    """
+    批量读取 symbols 的日线 (kwargs 传给 get_ak_stock_zh_a_daily_bulk) 并写入合并存储
+    """
+    stock_data = get_ak_stock_zh_a_daily_bulk(symbols, cache_dir, adjust=adjust, **kwargs)
+    store_dir = store_dir or get_store_path(cache_dir, adjust)
+    write_store(stock_data, store_dir)
+    return Store(store_dir)
+
+
+def open_ak_stock_zh_a_daily_store(cache_dir, adjust=None, store_dir=None):
+    return Store(store_dir or get_store_path(cache_dir, adjust))
+
+
+def get_ak_stock_zh_index_daily(symbol, cache_dir, update=False):
+    cache_path = "%s/ak_stock_zh_index_daily-%s.pkl" % (cache_dir, symbol)
+    if os.path.isfile(cache_path) and not update:
+        index_data = pd.read_pickle(cache_path)
+    else:
+        index_data = ak.stock_zh_index_daily(symbol=symbol)
+        index_data.to_pickle(cache_path)
+    return index_data
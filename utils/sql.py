@@ -0,0 +1,81 @@
+import datetime
+
+import backtrader as bt
+
+
+# 参数占位符
+PLACEHOLDER = {"mysql": "%s", "sqlite": "?"}
+
+
+def iter_bars(db, stock_code, start=None, end=None, chunk_size=1000, dialect="mysql", cursor_class=None):
+    """
+    按日期升序逐行读取 stock_all 中 [start, end] 区间的日线 (state_dt, open, high, low, close, vol)
+    走 (stock_code, state_dt) 唯一索引, 每次 fetchmany 一块, 不一次性读入全部历史
+    cursor_class: 游标类型, MySQL 下默认为 pymysql.cursors.SSCursor (服务端游标, 结果不在客户端缓存)
+    """
+    placeholder = PLACEHOLDER[dialect]
+    sql_select = (
+        "SELECT state_dt, open, high, low, close, vol FROM stock_all "
+        "WHERE stock_code = {0} AND state_dt >= {0} AND state_dt <= {0} ORDER BY state_dt"
+    ).format(placeholder)
+    start = start.strftime("%Y-%m-%d") if start is not None else "0000-00-00"
+    end = end.strftime("%Y-%m-%d") if end is not None else "9999-99-99"
+
+    if cursor_class is None and dialect == "mysql":
+        import pymysql
+        cursor_class = pymysql.cursors.SSCursor
+
+    cursor = db.cursor(cursor_class) if cursor_class is not None else db.cursor()
+    try:
+        cursor.execute(sql_select, (stock_code, start, end))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+class SQLData(bt.feed.DataBase):
+    """
+    从 tush.py 写入的 stock_all 表流式读取日线的 backtrader 数据源
+
+    data = SQLData(db=db, stock_code="600570.SH", fromdate=date_start, todate=date_final)
+    SQLite 连接传入 dialect="sqlite"
+    """
+
+    params = (
+        ("db", None),
+        ("stock_code", None),
+        ("dialect", "mysql"),
+        ("chunk_size", 1000),
+        ("cursor_class", None),
+    )
+
+    def start(self):
+        super(SQLData, self).start()
+        self.rows = iter_bars(
+            self.p.db, self.p.stock_code, self.p.fromdate, self.p.todate,
+            chunk_size=self.p.chunk_size, dialect=self.p.dialect, cursor_class=self.p.cursor_class
+        )
+
+    def stop(self):
+        self.rows.close()
+        super(SQLData, self).stop()
+
+    def _load(self):
+        row = next(self.rows, None)
+        if row is None:
+            return False
+
+        state_dt, price_open, price_high, price_low, price_close, volume = row
+        self.lines.datetime[0] = bt.date2num(datetime.datetime.strptime(str(state_dt), "%Y-%m-%d"))
+        self.lines.open[0] = float(price_open)
+        self.lines.high[0] = float(price_high)
+        self.lines.low[0] = float(price_low)
+        self.lines.close[0] = float(price_close)
+        self.lines.volume[0] = float(volume)
+        self.lines.openinterest[0] = 0.
+        return True
@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+FIELDS = ["open", "high", "low", "close", "volume"]
+
+
+def to_day(date):
+    return pd.Timestamp(date).to_datetime64().astype("datetime64[D]")
+
+
+def save_array(path, array):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+    return
+
+
+def write_store(frames, store_dir, fields=FIELDS):
+    """
+    多只股票的日线合并为一个存储, 每个字段一个 (股票 x 日期) 矩阵 <field>.npy, 缺失处为 nan
+    symbols.txt 为股票表, dates.npy 为日期表, offsets.npy 为每只股票首末日期在日期表中的下标
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    symbols = list(frames)
+    frame_dates = [pd.DatetimeIndex(frame.index).values.astype("datetime64[D]") for frame in frames.values()]
+    dates = np.unique(np.concatenate(frame_dates)) if frame_dates else np.array([], dtype="datetime64[D]")
+
+    positions = [np.searchsorted(dates, values) for values in frame_dates]
+    offsets = np.array([(pos[0], pos[-1] + 1) if len(pos) else (0, 0) for pos in positions], dtype=np.int64)
+
+    for field in fields:
+        path = "%s/%s.npy" % (store_dir, field)
+        values = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=float, shape=(len(symbols), len(dates)))
+        values[:] = np.nan
+        for i, frame in enumerate(frames.values()):
+            values[i, positions[i]] = frame[field].values
+        values.flush()
+        del values
+        os.replace(path + ".tmp", path)
+
+    save_array("%s/dates.npy" % store_dir, dates)
+    save_array("%s/offsets.npy" % store_dir, offsets.reshape(-1, 2))
+    # 股票表最后写入, 读者看到新股票表时各字段已就绪
+    with open("%s/symbols.txt.tmp" % store_dir, "w") as f:
+        f.write("\n".join(symbols))
+    os.replace("%s/symbols.txt.tmp" % store_dir, "%s/symbols.txt" % store_dir)
+    return
+
+
+class Store(object):
+    """
+    write_store 写入的合并存储, 各字段按需内存映射
+
+    series: 单只股票的时间序列, 读取矩阵中连续的一行
+    cross_section: 某一交易日全部股票的截面, 读取矩阵中的一列, 不需要逐个打开文件
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open("%s/symbols.txt" % store_dir) as f:
+            self.symbols = [symbol for symbol in f.read().split("\n") if symbol]
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.dates = np.load("%s/dates.npy" % store_dir)
+        self.offsets = np.load("%s/offsets.npy" % store_dir)
+        self.columns = {}
+
+    def column(self, field):
+        if field not in self.columns:
+            self.columns[field] = np.load("%s/%s.npy" % (self.store_dir, field), mmap_mode="r")
+        return self.columns[field]
+
+    def series(self, symbol, fields=FIELDS, start=None, end=None, df=True):
+        i = self.index[symbol]
+        first, last = self.offsets[i]
+        if start is not None:
+            first = max(first, np.searchsorted(self.dates, to_day(start), side="left"))
+        if end is not None:
+            last = min(last, np.searchsorted(self.dates, to_day(end), side="right"))
+        data = {field: self.column(field)[i, first:last] for field in fields}
+        dates = self.dates[first:last]
+        # 去掉停牌日 (该股票在合并日期表中缺失的日期)
+        traded = ~np.isnan(self.column("close")[i, first:last])
+        if not traded.all():
+            data = {field: values[traded] for field, values in data.items()}
+            dates = dates[traded]
+        if not df:
+            return dates, data
+        return pd.DataFrame(data, index=pd.DatetimeIndex(dates, name="date"), copy=False)
+
+    def cross_section(self, date, fields=FIELDS, df=True):
+        j = np.searchsorted(self.dates, to_day(date))
+        if j == len(self.dates) or self.dates[j] != to_day(date):
+            raise KeyError(date)
+        data = {field: self.column(field)[:, j] for field in fields}
+        if not df:
+            return self.symbols, data
+        return pd.DataFrame(data, index=pd.Index(self.symbols, name="symbol"))